@@ -0,0 +1,79 @@
+"""
+@file          benchmark_decode.py
+@brief         compare the per song decode latency of the in-process decoder and ffmpeg
+@author        paradigm
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+
+from ultrastar_pitch.audio_decoder import AudioDecoder
+from ultrastar_pitch.library_processor import find_projects
+from ultrastar_pitch.project_parser import ProjectParser
+
+
+def decode_time(decoder: AudioDecoder, audio_path: str, sample_rate: int, repeats: int) -> (float, np.ndarray):
+    """ returns the mean decode time in seconds and the decoded samples """
+    samples = decoder.decode(audio_path, sample_rate)
+    t_start = time.perf_counter()
+    for _ in range(repeats):
+        decoder.decode(audio_path, sample_rate)
+    return (time.perf_counter() - t_start) / repeats, samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("paths", nargs="+", help="audio files or song library folders")
+    parser.add_argument("--note-file", default="notes.txt", help="name of the project files in a library")
+    parser.add_argument("--sample-rate", type=int, default=16000, help="target sample rate")
+    parser.add_argument("--repeats", type=int, default=5, help="number of decodes per file and path")
+    args = parser.parse_args()
+
+    # collect the audio files of the given libraries
+    audio_paths = []
+    project_parser = ProjectParser()
+    for path in args.paths:
+        if not os.path.isdir(path):
+            audio_paths.append(path)
+            continue
+        for project in find_projects(path, args.note_file):
+            project_parser.load_note_file(project)
+            audio_paths.append(os.path.join(project_parser.proj_dir, project_parser.meta["#MP3"]))
+
+    native = AudioDecoder(native=True)
+    ffmpeg = AudioDecoder(native=False)
+    print(
+        "{0:<40}{1:>14}{2:>14}{3:>10}{4:>14}".format(
+            "file", "native [ms]", "ffmpeg [ms]", "speedup", "rms diff"
+        )
+    )
+    totals = np.zeros(2)
+    for audio_path in audio_paths:
+        name = os.path.basename(audio_path)
+        if native.decode_native(audio_path, args.sample_rate) is None:
+            print("{0:<40}{1:>14}".format(name[-39:], "unsupported"))
+            continue
+        native_time, native_samples = decode_time(native, audio_path, args.sample_rate, args.repeats)
+        ffmpeg_time, ffmpeg_samples = decode_time(ffmpeg, audio_path, args.sample_rate, args.repeats)
+        totals += native_time, ffmpeg_time
+        # deviation of the resamplers relative to full scale
+        n_samples = min(len(native_samples), len(ffmpeg_samples))
+        deviation = native_samples[:n_samples].astype(np.float64) - ffmpeg_samples[:n_samples]
+        rms = np.sqrt(np.mean(deviation ** 2)) / 32768 if n_samples else 0.0
+        print(
+            "{0:<40}{1:>14.2f}{2:>14.2f}{3:>10.1f}{4:>14.2e}".format(
+                name[-39:], native_time * 1e3, ffmpeg_time * 1e3, ffmpeg_time / native_time, rms
+            )
+        )
+    if totals[0] > 0:
+        print(
+            "{0:<40}{1:>14.2f}{2:>14.2f}{3:>10.1f}".format(
+                "total", totals[0] * 1e3, totals[1] * 1e3, totals[1] / totals[0]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+@file          benchmark_stages.py
+@brief         time every stage of the pipeline on reproducible synthetic songs and
+               save the throughput as json for comparisons between versions
+@author        paradigm
+"""
+
+import json
+import time
+import argparse
+import platform
+import tempfile
+import numpy as np
+
+from ultrastar_pitch.version import __version__
+from ultrastar_pitch.project_parser import ProjectParser
+from ultrastar_pitch.audio_decoder import AudioDecoder
+from ultrastar_pitch.audio_preprocessor import AudioPreprocessor, QUALITY_PRESETS
+from ultrastar_pitch.pitch_classifier import PitchClassifier
+from ultrastar_pitch.stochastic_postprocessor import StochasticPostprocessor
+from ultrastar_pitch.detection_pipeline import DetectionPipeline
+from ultrastar_pitch.pitch_utils import peak_rss
+
+from synthetic_songs import make_library
+
+# stages in pipeline order
+STAGES = ["parse", "decode", "preprocess", "predict", "postprocess"]
+
+
+class StageTimer:
+    """ pipeline hook accumulating the time, notes and frames processed by each stage """
+
+    def __init__(self):
+        self.stages = {stage: {"seconds": 0.0, "notes": 0, "frames": 0} for stage in STAGES}
+
+    def __call__(self, event: dict):
+        # the song and write events enclose or follow the measured stages
+        if event["stage"] in self.stages:
+            self.add(event["stage"], event["duration"], event["segments"], event["frames"])
+
+    def add(self, stage: str, seconds: float, notes: int = 0, frames: int = 0):
+        self.stages[stage]["seconds"] += seconds
+        self.stages[stage]["notes"] += notes
+        self.stages[stage]["frames"] += int(frames)
+        self.stages[stage]["peak_rss_mb"] = peak_rss()
+
+    def report(self) -> dict:
+        """ returns the totals together with the throughput of each stage """
+        report = {}
+        for stage, stats in self.stages.items():
+            seconds = stats["seconds"]
+            report[stage] = dict(stats)
+            report[stage]["notes_per_second"] = stats["notes"] / seconds if seconds else None
+            report[stage]["frames_per_second"] = stats["frames"] / seconds if seconds else None
+        return report
+
+
+def benchmark_song(
+    project: str, timer: StageTimer, pipeline: DetectionPipeline, repeats: int
+) -> (np.ndarray, np.ndarray, np.ndarray):
+    """ detect one song with the pipeline, whose stage events are collected by the timer,
+    returns the true, raw and postprocessed pitches
+    """
+    pitches_true, segments_prob = pipeline.analyse(project)
+    pitches_raw = segments_prob.argmax(axis=1)
+    # the postprocessing is too fast for a single measurement
+    t_start = time.perf_counter()
+    for _ in range(repeats):
+        pitches_post = pipeline.stochastic_postprocessor.transform(segments_prob)
+    timer.add("postprocess", (time.perf_counter() - t_start) / repeats, len(segments_prob))
+    return pitches_true, pitches_raw, pitches_post
+
+
+def compare(report: dict, baseline: dict):
+    """ print the throughput change of every stage relative to a baseline report """
+    print("\n{0:<14}{1:>16}{2:>16}{3:>10}".format("stage", "baseline", "current", "change"))
+    for stage in STAGES:
+        metric = "frames_per_second" if stage in ("preprocess", "predict") else "notes_per_second"
+        old = baseline["stages"].get(stage, {}).get(metric)
+        new = report["stages"][stage][metric]
+        if not old or not new:
+            continue
+        print(
+            "{0:<14}{1:>16.0f}{2:>16.0f}{3:>+9.1f}%".format(stage, old, new, (new / old - 1) * 100)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--songs", type=int, default=8, help="number of synthetic songs")
+    parser.add_argument("--notes", type=int, default=200, help="notes per song")
+    parser.add_argument("--density", type=float, default=0.7, help="share of a song covered by notes")
+    parser.add_argument("--bpm", type=float, default=300.0, help="tempo of the songs")
+    parser.add_argument("--gaps", type=float, default=0.0, help="share of notes sung only partly")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the song generator")
+    parser.add_argument("--library", help="keep the generated songs in this folder")
+    parser.add_argument("--quality", default="accurate", choices=list(QUALITY_PRESETS), help="preprocessor preset")
+    parser.add_argument("--stride", type=int, help="preprocessor stride (default=stride of the preset)")
+    parser.add_argument("--float32", action="store_true", help="compute features in single precision")
+    parser.add_argument("--gate-db", type=float, help="skip frames quieter than this level in dBFS")
+    parser.add_argument("--batch-frames", type=int, default=2048, help="frames predicted at once")
+    parser.add_argument("--threads", type=int, default=0, help="inference threads (0=all cores)")
+    parser.add_argument("--repeats", type=int, default=20, help="repetitions of the postprocessing")
+    parser.add_argument("--output", help="save the report as json")
+    parser.add_argument("--compare", help="compare with a previously saved report")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        library = args.library or tmp_dir
+        projects = make_library(
+            library,
+            args.songs,
+            args.seed,
+            n_notes=args.notes,
+            density=args.density,
+            bpm=args.bpm,
+            gaps=args.gaps,
+        )
+        preset = dict(QUALITY_PRESETS[args.quality])
+        if args.stride:
+            preset["stride"] = args.stride
+        # the pipeline of the command line without caches, every song is decoded and predicted
+        pipeline = DetectionPipeline(
+            ProjectParser(decoder=AudioDecoder()),
+            AudioPreprocessor(
+                dtype=np.float32 if args.float32 else np.float64, gate_db=args.gate_db, **preset
+            ),
+            PitchClassifier(intra_op_threads=args.threads),
+            StochasticPostprocessor(),
+            max_batch_frames=args.batch_frames,
+        )
+        timer = StageTimer()
+        pipeline.add_hook(timer)
+        results = [benchmark_song(project, timer, pipeline, args.repeats) for project in projects]
+
+    pitches_true, pitches_raw, pitches_post = (np.concatenate(pitches) for pitches in zip(*results))
+    report = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "config": vars(args),
+        "stages": timer.report(),
+        "accuracy": {
+            "raw": float(np.mean(pitches_true == pitches_raw)),
+            "postprocessed": float(np.mean(pitches_true == pitches_post)),
+        },
+        "peak_rss_mb": peak_rss(),
+    }
+    # share of the frames skipped by the energy gate
+    report["pruned"] = 1 - report["stages"]["predict"]["frames"] / report["stages"]["preprocess"]["frames"]
+
+    print("{0:<14}{1:>12}{2:>14}{3:>16}{4:>14}".format("stage", "seconds", "notes/s", "frames/s", "peak rss"))
+    for stage, stats in report["stages"].items():
+        print(
+            "{0:<14}{1:>12.3f}{2:>14.0f}{3:>16}{4:>11.0f} MB".format(
+                stage,
+                stats["seconds"],
+                stats["notes_per_second"] or 0,
+                "{0:.0f}".format(stats["frames_per_second"]) if stats["frames"] else "-",
+                stats.get("peak_rss_mb") or 0,
+            )
+        )
+    print(
+        "\naccuracy raw: {0:.2f}%, postprocessed: {1:.2f}%".format(
+            report["accuracy"]["raw"] * 100, report["accuracy"]["postprocessed"] * 100
+        )
+    )
+    print("pruned frames: {0:.1f}%".format(report["pruned"] * 100))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as baseline_file:
+            compare(report, json.load(baseline_file))
+
+
+if __name__ == "__main__":
+    main()
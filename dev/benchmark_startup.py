@@ -0,0 +1,70 @@
+"""
+@file          benchmark_startup.py
+@brief         measure the startup time of the command line interface and check
+               that no heavy module is imported before it is needed
+@author        paradigm
+"""
+
+import sys
+import time
+import argparse
+import subprocess
+
+# modules, which must not be imported for showing the help
+HEAVY_MODULES = ["numpy", "scipy", "onnxruntime", "tkinter"]
+
+# print the heavy modules imported by the help of the command line interface
+CHECK_SCRIPT = """
+import sys
+sys.argv = ["ultrastar-pitch", "--help"]
+from ultrastar_pitch.ultrastar_pitch import main
+try:
+    main()
+except SystemExit:
+    pass
+print("imported:" + ",".join(module for module in {0} if module in sys.modules))
+""".format(HEAVY_MODULES)
+
+
+def run_time(command: list, repeats: int) -> float:
+    """ returns the mean wall time of a command in seconds """
+    t_start = time.perf_counter()
+    for _ in range(repeats):
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - t_start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeats", type=int, default=10, help="number of runs per command")
+    args = parser.parse_args()
+
+    baseline = run_time([sys.executable, "-c", "pass"], args.repeats)
+    help_time = run_time([sys.executable, "-m", "ultrastar_pitch", "--help"], args.repeats)
+    import_time = run_time([sys.executable, "-c", "import ultrastar_pitch.ultrastar_pitch"], args.repeats)
+    pipeline_time = run_time(
+        [
+            sys.executable,
+            "-c",
+            "import ultrastar_pitch; "
+            "ultrastar_pitch.AudioPreprocessor(); ultrastar_pitch.PitchClassifier()",
+        ],
+        args.repeats,
+    )
+    print("interpreter startup:  {0:7.1f} ms".format(baseline * 1e3))
+    print("import cli module:    {0:7.1f} ms".format(import_time * 1e3))
+    print("show help:            {0:7.1f} ms".format(help_time * 1e3))
+    print("load pipeline stages: {0:7.1f} ms".format(pipeline_time * 1e3))
+
+    output = subprocess.run(
+        [sys.executable, "-c", CHECK_SCRIPT], stdout=subprocess.PIPE, check=True, text=True
+    ).stdout
+    imported = output[output.rindex("imported:") + len("imported:") :].strip()
+    if imported:
+        print("\nheavy modules imported by --help: " + imported)
+        sys.exit(1)
+    print("\nno heavy modules imported by --help")
+
+
+if __name__ == "__main__":
+    main()
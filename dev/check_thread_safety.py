@@ -0,0 +1,97 @@
+"""
+@file          check_thread_safety.py
+@brief         verify that concurrent predictions of one shared pitch classifier match serial ones
+@author        paradigm
+"""
+
+import time
+import argparse
+import threading
+import numpy as np
+
+from ultrastar_pitch.pitch_classifier import PitchClassifier
+
+# feature size of the model input
+FEATURE_SIZE = 2048
+
+
+def make_batches(n_batches: int, max_batch_size: int, seed: int) -> list:
+    """ returns reproducible random feature batches of different sizes """
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(1, max_batch_size + 1, n_batches)
+    return [rng.random((size, FEATURE_SIZE), dtype=np.float32) for size in sizes]
+
+
+def predict_concurrently(classifier: PitchClassifier, batches: list, n_threads: int, rounds: int) -> list:
+    """ returns the batch indexes and predictions of every thread, all threads start at once
+    and run every batch in their own order
+    """
+    barrier = threading.Barrier(n_threads)
+    results = [None] * n_threads
+    errors = []
+
+    def work(thread_idx: int):
+        # shift the order, so different batch sizes run at the same time
+        order = np.roll(np.arange(len(batches)), thread_idx)
+        predictions = []
+        try:
+            barrier.wait()
+            for _ in range(rounds):
+                for idx in order:
+                    predictions.append((idx, classifier.predict(batches[idx])))
+        except Exception as e:
+            errors.append(e)
+        results[thread_idx] = predictions
+
+    threads = [threading.Thread(target=work, args=(idx,)) for idx in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--threads", type=int, default=8, help="number of concurrent threads")
+    parser.add_argument("--batches", type=int, default=16, help="number of feature batches")
+    parser.add_argument("--batch-size", type=int, default=512, help="maximum frames per batch")
+    parser.add_argument("--rounds", type=int, default=5, help="passes over the batches per thread")
+    parser.add_argument("--intra-threads", type=int, default=0, help="intra op threads of the session")
+    parser.add_argument("--sequential", action="store_true", help="sequential execution mode")
+    parser.add_argument("--quantize", action="store_true", help="check the int8 quantized model")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random features")
+    args = parser.parse_args()
+
+    classifier = PitchClassifier(
+        intra_op_threads=args.intra_threads, parallel=not args.sequential, quantized=args.quantize
+    )
+    batches = make_batches(args.batches, args.batch_size, args.seed)
+    expected = [classifier.predict(batch) for batch in batches]
+    t_start = time.perf_counter()
+    results = predict_concurrently(classifier, batches, args.threads, args.rounds)
+    seconds = time.perf_counter() - t_start
+    mismatches = [
+        (thread_idx, batch_idx, prediction)
+        for thread_idx, predictions in enumerate(results)
+        for batch_idx, prediction in predictions
+        if prediction.shape != expected[batch_idx].shape or not np.array_equal(prediction, expected[batch_idx])
+    ]
+    n_frames = sum(len(batch) for batch in batches) * args.threads * args.rounds
+    print(
+        "{0} threads predicted {1} frames in {2:.2f}s, {3} of {4} batches differ from the serial run".format(
+            args.threads, n_frames, seconds, len(mismatches), len(batches) * args.threads * args.rounds
+        )
+    )
+    for thread_idx, batch_idx, prediction in mismatches[:10]:
+        shape_ok = prediction.shape == expected[batch_idx].shape
+        deviation = np.abs(prediction - expected[batch_idx]).max() if shape_ok else np.inf
+        print("\tthread {0}, batch {1}: max deviation {2:.3g}".format(thread_idx, batch_idx, deviation))
+    assert not mismatches, "concurrent predictions differ from the serial ones"
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
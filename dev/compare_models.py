@@ -0,0 +1,113 @@
+"""
+@file          compare_models.py
+@brief         compare load time, inference latency and accuracy of the model variants
+@author        paradigm
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+
+from ultrastar_pitch.project_parser import ProjectParser
+from ultrastar_pitch.audio_preprocessor import AudioPreprocessor
+from ultrastar_pitch.pitch_classifier import PitchClassifier
+from ultrastar_pitch.stochastic_postprocessor import StochasticPostprocessor
+from ultrastar_pitch.detection_pipeline import DetectionPipeline
+from ultrastar_pitch.pitch_utils import prediction_score
+
+# model variants as pitch classifier arguments
+VARIANTS = {
+    "original": {"quantized": False, "model_cache": False},
+    "optimized": {"quantized": False, "model_cache": True},
+    "int8": {"quantized": True, "model_cache": False},
+    "int8-optimized": {"quantized": True, "model_cache": True},
+}
+# stride used by the command line interface
+STRIDE = 128
+
+
+def load_time(cache_path: str, repeats: int, **kwargs) -> float:
+    """ returns the mean load time of a model variant in seconds """
+    # create the cached files beforehand
+    PitchClassifier(cache_path=cache_path, **kwargs)
+    t_start = time.perf_counter()
+    for _ in range(repeats):
+        PitchClassifier(cache_path=cache_path, **kwargs)
+    return (time.perf_counter() - t_start) / repeats
+
+
+def frame_latency(classifier: PitchClassifier, features: np.ndarray, batch_size: int) -> float:
+    """ returns the mean inference time per frame in seconds """
+    classifier.predict(features[:batch_size])
+    t_start = time.perf_counter()
+    for idx in range(0, len(features), batch_size):
+        classifier.predict(features[idx : idx + batch_size])
+    return (time.perf_counter() - t_start) / len(features)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("projects", nargs="*", help="note files of the test set")
+    parser.add_argument("--repeats", type=int, default=20, help="number of loads per variant")
+    parser.add_argument("--batch-size", type=int, default=2048, help="frames per prediction")
+    parser.add_argument("--confusion", action="store_true", help="print the confusion matrices")
+    args = parser.parse_args()
+
+    project_parser = ProjectParser()
+    preprocessor = AudioPreprocessor(stride=STRIDE, dtype=np.float32)
+    # collect the features of the test set for the latency measurement
+    features = []
+    for project in args.projects:
+        project_parser.load_note_file(project)
+        for samples, bounds in project_parser.process_audio_batches():
+            features.append(preprocessor.transform_batch(samples, bounds[:, 0], bounds[:, 1])[0].copy())
+    if features:
+        features = np.vstack(features)
+    else:
+        # no test set, measure the latency with random features
+        features = np.random.default_rng(0).random((8192, 2048), dtype=np.float32)
+
+    report = {}
+    with tempfile.TemporaryDirectory() as cache_path:
+        for name, kwargs in VARIANTS.items():
+            classifier = PitchClassifier(cache_path=cache_path, **kwargs)
+            result = {
+                "load": load_time(cache_path, args.repeats, **kwargs),
+                "latency": frame_latency(classifier, features, args.batch_size),
+                "accuracy": None,
+            }
+            if args.projects:
+                pipeline = DetectionPipeline(
+                    ProjectParser(), preprocessor, classifier, StochasticPostprocessor()
+                )
+                pitches_org, pitches_new = [], []
+                for project in args.projects:
+                    # measure the raw model accuracy without postprocessing
+                    org, new = pipeline.transform(
+                        project, os.path.join(cache_path, "notes_new.txt"), False
+                    )
+                    pitches_org.append(org)
+                    pitches_new.append(new)
+                y_true, y_pred = np.concatenate(pitches_org), np.concatenate(pitches_new)
+                if args.confusion:
+                    print(name)
+                    result["accuracy"] = prediction_score(y_true, y_pred)
+                    print()
+                else:
+                    result["accuracy"] = np.mean(y_true == y_pred)
+            report[name] = result
+
+    print("{0:<16}{1:>12}{2:>16}{3:>12}".format("variant", "load [ms]", "frame [us]", "accuracy"))
+    for name, result in report.items():
+        accuracy = "-" if result["accuracy"] is None else "{0:.2f}%".format(result["accuracy"] * 100)
+        print(
+            "{0:<16}{1:>12.2f}{2:>16.2f}{3:>12}".format(
+                name, result["load"] * 1e3, result["latency"] * 1e6, accuracy
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
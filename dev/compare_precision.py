@@ -0,0 +1,70 @@
+"""
+@file          compare_precision.py
+@brief         compare accuracy and peak memory of the float32 and float64 feature paths
+@author        paradigm
+"""
+
+import sys
+import argparse
+import tracemalloc
+import numpy as np
+
+from ultrastar_pitch.project_parser import ProjectParser
+from ultrastar_pitch.audio_preprocessor import AudioPreprocessor
+from ultrastar_pitch.pitch_classifier import PitchClassifier
+
+# stride used by the command line interface
+STRIDE = 128
+
+
+def predict_song(preprocessor, classifier, samples, bounds):
+    """ transform and predict a whole song at once, returns features, probabilities and peak memory """
+    tracemalloc.start()
+    features, offsets = preprocessor.transform_batch(samples, bounds[:, 0], bounds[:, 1])
+    pitches_prob = classifier.predict(features)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    segments_prob = np.add.reduceat(pitches_prob, offsets[:-1], axis=0)
+    return np.array(features, dtype=np.float64), segments_prob, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("projects", nargs="+", help="note files of the test songs")
+    args = parser.parse_args()
+
+    project_parser = ProjectParser()
+    classifier = PitchClassifier()
+    preprocessors = {
+        "float64": AudioPreprocessor(stride=STRIDE, dtype=np.float64),
+        "float32": AudioPreprocessor(stride=STRIDE, dtype=np.float32),
+    }
+    agreement = []
+    for project in args.projects:
+        project_parser.load_note_file(project)
+        bounds = project_parser.segment_bounds()
+        # decode the complete song once for both paths
+        for samples, _ in project_parser.stream_audio():
+            pass
+        samples = np.array(samples[: bounds[:, 1].max() if len(bounds) else 0])
+        results = {
+            name: predict_song(preprocessor, classifier, samples, bounds)
+            for name, preprocessor in preprocessors.items()
+        }
+        feat_64, prob_64, peak_64 = results["float64"]
+        feat_32, prob_32, peak_32 = results["float32"]
+        same = np.mean(prob_64.argmax(axis=1) == prob_32.argmax(axis=1))
+        agreement.append(same)
+        print(project)
+        print("\tframes:              {0}".format(len(feat_64)))
+        print("\tmax feature error:   {0:.2e}".format(np.abs(feat_64 - feat_32).max()))
+        print("\tmax segment error:   {0:.2e}".format(np.abs(prob_64 - prob_32).max()))
+        print("\tpitch agreement:     {0:.2f}%".format(same * 100))
+        print("\tpeak memory float64: {0:.1f} MB".format(peak_64 / 2 ** 20))
+        print("\tpeak memory float32: {0:.1f} MB".format(peak_32 / 2 ** 20))
+    print("\nmean pitch agreement: {0:.2f}%".format(np.mean(agreement) * 100))
+    return 0 if np.mean(agreement) > 0.99 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+"""
+@file          generate_shards.py
+@brief         read in karaoke databases with a pool of worker processes and append the
+               raw audio segments to large int16 shards with a memory mappable index
+@author        paradigm
+"""
+
+import os
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+
+from ultrastar_pitch.audio_decoder import AudioDecoder
+from ultrastar_pitch.library_processor import find_projects
+from ultrastar_pitch.project_parser import ProjectParser
+
+# one record per segment: shard number, offset and length in samples, pitch label and song number
+INDEX_DTYPE = np.dtype(
+    [("shard", "<u2"), ("offset", "<u8"), ("length", "<u4"), ("label", "u1"), ("song", "<u4")]
+)
+INDEX_FILE = "index.bin"
+# completed projects, every line contains the number of index records after the project and its path
+DONE_FILE = "done.txt"
+SHARD_NAME = "shard-{0:05d}.i16"
+
+# state of the worker processes, created once by the pool initializer
+_PARSER = None
+_SEPARATOR = None
+
+
+def shard_path(data_dir: str, shard: int) -> str:
+    """ returns the path of a shard file """
+    return os.path.join(data_dir, SHARD_NAME.format(shard))
+
+
+def load_index(data_dir: str) -> np.ndarray:
+    """ returns the memory mapped index records of a data folder """
+    index_path = os.path.join(data_dir, INDEX_FILE)
+    if not os.path.getsize(index_path):
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    return np.memmap(index_path, dtype=INDEX_DTYPE, mode="r")
+
+
+def load_segments(data_dir: str):
+    """ yield the memory mapped audio segments of a data folder together with their labels """
+    index = load_index(data_dir)
+    shards = {}
+    for record in index:
+        shard = int(record["shard"])
+        if shard not in shards:
+            shards[shard] = np.memmap(shard_path(data_dir, shard), dtype="<i2", mode="r")
+        offset = int(record["offset"])
+        yield shards[shard][offset : offset + int(record["length"])], int(record["label"])
+
+
+def read_done(data_dir: str) -> (list, list):
+    """ returns the completed projects and the number of index records after each of them """
+    done, n_records = [], []
+    done_path = os.path.join(data_dir, DONE_FILE)
+    if not os.path.exists(done_path):
+        return done, n_records
+    with open(done_path, "r", encoding="utf-8") as done_file:
+        for line in done_file:
+            # a line without line break was interrupted while writing
+            if not line.endswith("\n"):
+                break
+            records, project = line.rstrip("\n").split("\t", 1)
+            done.append(project)
+            n_records.append(int(records))
+    return done, n_records
+
+
+def _init_worker(spleeter: bool):
+    """ init the project parser and the optional vocal separator once per worker """
+    global _PARSER, _SEPARATOR
+    _PARSER = ProjectParser(decoder=AudioDecoder())
+    if spleeter:
+        from spleeter.separator import Separator
+
+        # init spleeter separator for vocal and instrumental stems
+        _SEPARATOR = Separator("spleeter:2stems")
+
+
+def _extract_project(job: tuple) -> dict:
+    """ returns the concatenated audio segments of a project together with their lengths and labels """
+    project, sample_rate = job
+    result = {"project": project, "error": None}
+    tmp_dir = None
+    try:
+        _PARSER.load_note_file(project)
+        if _SEPARATOR is not None:
+            # isolate the vocals into a temporary folder, which keeps the library untouched
+            tmp_dir = tempfile.mkdtemp()
+            audio_path = os.path.join(_PARSER.proj_dir, _PARSER.meta["#MP3"])
+            _SEPARATOR.separate_to_file(audio_path, tmp_dir, filename_format="{instrument}.{codec}")
+            _PARSER.meta["#MP3"] = os.path.join(tmp_dir, "vocals.wav")
+        segments = list(_PARSER.process_audio(sample_rate=sample_rate))
+        result["labels"] = np.asarray(_PARSER.dump_pitches(), dtype=np.uint8)[: len(segments)]
+        result["lengths"] = np.array([len(segment) for segment in segments], dtype=np.uint32)
+        result["samples"] = (
+            np.concatenate(segments).astype("<i2", copy=False)
+            if segments
+            else np.zeros(0, dtype="<i2")
+        )
+    except Exception as e:
+        result["error"] = "{0}: {1}".format(type(e).__name__, e)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return result
+
+
+class ShardWriter:
+    """ append the segments of complete projects to the shards, the index and the done list
+
+    The data of a project is written and flushed before the project is marked as done, so an
+    interrupted run can be resumed. Records after the last done project are dropped on resume.
+    """
+
+    def __init__(self, data_dir: str, shard_size: int):
+        """ open the data folder and restore the state of a previous run """
+        self.data_dir = data_dir
+        self.shard_size = shard_size
+        os.makedirs(data_dir, exist_ok=True)
+        self.done, done_records = read_done(data_dir)
+        n_records = done_records[-1] if done_records else 0
+        # rewrite the done list without an interrupted last line
+        self.done_file = open(os.path.join(data_dir, DONE_FILE), "w", encoding="utf-8")
+        self.done_file.writelines(
+            "{0}\t{1}\n".format(records, project) for records, project in zip(done_records, self.done)
+        )
+        self.done_file.flush()
+        index_path = os.path.join(data_dir, INDEX_FILE)
+        self.index_file = open(index_path, "ab")
+        # drop the records of an interrupted project
+        self.index_file.truncate(n_records * INDEX_DTYPE.itemsize)
+        self.n_records = n_records
+        self.shard, self.offset = 0, 0
+        if n_records:
+            last = np.fromfile(
+                index_path, dtype=INDEX_DTYPE, count=1, offset=(n_records - 1) * INDEX_DTYPE.itemsize
+            )[0]
+            self.shard, self.offset = int(last["shard"]), int(last["offset"] + last["length"])
+        self.shard_file = open(shard_path(data_dir, self.shard), "ab")
+        # drop the samples of an interrupted project
+        self.shard_file.truncate(self.offset * 2)
+
+    def append(self, project: str, samples: np.ndarray, lengths: np.ndarray, labels: np.ndarray):
+        """ write the segments of a project and mark it as done """
+        if self.offset and (self.offset + len(samples)) * 2 > self.shard_size:
+            # start a new shard, a project never spans two shards
+            self.shard_file.close()
+            self.shard += 1
+            self.offset = 0
+            self.shard_file = open(shard_path(self.data_dir, self.shard), "wb")
+        records = np.zeros(len(lengths), dtype=INDEX_DTYPE)
+        records["shard"] = self.shard
+        records["offset"] = self.offset + np.concatenate(([0], np.cumsum(lengths, dtype=np.uint64)[:-1]))
+        records["length"] = lengths
+        records["label"] = labels
+        records["song"] = len(self.done)
+        self.shard_file.write(samples.tobytes())
+        self.shard_file.flush()
+        self.index_file.write(records.tobytes())
+        self.index_file.flush()
+        self.offset += len(samples)
+        self.n_records += len(records)
+        self.done.append(project)
+        self.done_file.write("{0}\t{1}\n".format(self.n_records, project))
+        self.done_file.flush()
+
+    def close(self):
+        """ close all files """
+        self.shard_file.close()
+        self.index_file.close()
+        self.done_file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("libraries", nargs="+", help="database root folders")
+    parser.add_argument("-o", "--output", required=True, help="directory for the training data")
+    parser.add_argument("--note-file", default="notes.txt", help="name of the project files")
+    parser.add_argument("--sample-rate", type=int, default=16000, help="sample rate of the segments")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default=cpu count)")
+    parser.add_argument("--shard-size", type=int, default=256, help="size limit of a shard in MB")
+    parser.add_argument("--spleeter", action="store_true", help="isolate the vocals with spleeter first")
+    parser.add_argument("--restart", action="store_true", help="remove previously created training data")
+    args = parser.parse_args()
+
+    if args.restart and os.path.isdir(args.output):
+        shutil.rmtree(args.output)
+        print("cleared " + args.output)
+    writer = ShardWriter(args.output, args.shard_size << 20)
+    done = set(writer.done)
+    projects = [
+        project
+        for library in args.libraries
+        for project in find_projects(library, args.note_file)
+        if project not in done
+    ]
+    print("{0} projects done, {1} remaining".format(len(done), len(projects)))
+    jobs = min(args.jobs or os.cpu_count() or 1, max(len(projects), 1))
+    n_failed = 0
+    try:
+        with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(args.spleeter,)) as pool:
+            tasks = [(project, args.sample_rate) for project in projects]
+            for idx, result in enumerate(pool.imap_unordered(_extract_project, tasks, chunksize=1)):
+                print("[{0}/{1}] {2}".format(idx + 1, len(projects), result["project"]))
+                if result["error"]:
+                    n_failed += 1
+                    print("\t" + result["error"])
+                    continue
+                writer.append(result["project"], result["samples"], result["lengths"], result["labels"])
+    finally:
+        writer.close()
+    print(
+        "finished! {0} segments of {1} projects in {2} shards, {3} failed".format(
+            writer.n_records, len(writer.done), writer.shard + 1, n_failed
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
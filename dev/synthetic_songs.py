@@ -0,0 +1,161 @@
+"""
+@file          synthetic_songs.py
+@brief         generate synthetic ultrastar projects with harmonic tones at known pitches
+@author        paradigm
+"""
+
+import os
+import wave
+import argparse
+import subprocess
+import numpy as np
+
+# intervals of the major scale in semitones
+MAJOR_SCALE = np.array([0, 2, 4, 5, 7, 9, 11])
+# midi range of the generated melodies
+MIDI_RANGE = (52, 76)
+# usdx pitch 0 corresponds to midi note 60 (C4)
+USDX_OFFSET = 60
+
+
+def render_note(midi: int, n_samples: int, sample_rate: int, harmonics: int, rng) -> np.ndarray:
+    """ returns a harmonic tone with a slight vibrato and short fades """
+    t = np.arange(n_samples) / sample_rate
+    frequency = 440 * 2 ** ((midi - 69) / 12)
+    # vibrato of +-20 cent with 5.5 Hz and a random phase
+    phase = 2 * np.pi * np.cumsum(
+        frequency * 2 ** (0.2 / 12 * np.sin(2 * np.pi * 5.5 * t + rng.uniform(0, 2 * np.pi)))
+    ) / sample_rate
+    tone = sum(np.sin(harmonic * phase) / harmonic for harmonic in range(1, harmonics + 1))
+    # 10 ms fades avoid clicks at the note borders
+    n_fade = min(n_samples // 2, sample_rate // 100)
+    envelope = np.ones(n_samples)
+    envelope[:n_fade] = np.linspace(0, 1, n_fade)
+    envelope[n_samples - n_fade :] = np.linspace(1, 0, n_fade)
+    return tone * envelope
+
+
+def make_project(
+    project_dir: str,
+    n_notes: int = 200,
+    density: float = 0.7,
+    bpm: float = 300.0,
+    seed: int = 0,
+    sample_rate: int = 44100,
+    harmonics: int = 5,
+    noise: float = 0.01,
+    audio_format: str = "wav",
+    gaps: float = 0.0,
+) -> np.ndarray:
+    """ write a notes.txt and an audio file into project_dir, returns the usdx pitches of the notes
+
+    density is the share of the song covered by notes, the rest are pauses between them.
+    Every tenth note is golden and a line break follows every eighth note. gaps is the share
+    of notes sung too late or stopped too early, which leaves only noise in a part of them.
+    """
+    assert 0 < density <= 1, "density has to be in (0, 1]"
+    assert 0 <= gaps <= 1, "gaps has to be in [0, 1]"
+    os.makedirs(project_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    gap_ms = 1000.0
+    beat_ms = 15000 / bpm
+    # melody as random walk on the scale of a random key
+    key = int(rng.integers(12))
+    scale = np.array(
+        [midi for midi in range(*MIDI_RANGE) if (midi - key) % 12 in MAJOR_SCALE]
+    )
+    steps = rng.choice([-2, -1, -1, 0, 1, 1, 2], size=n_notes)
+    degrees = np.clip(len(scale) // 2 + np.cumsum(steps), 0, len(scale) - 1)
+    midis = scale[degrees]
+    lengths = rng.integers(2, 9, size=n_notes)
+    # pauses scaled, so the notes cover the requested share of the song
+    pauses = np.round(rng.uniform(0, 2, size=n_notes) * lengths * (1 / density - 1)).astype(int)
+    starts = np.concatenate(([0], np.cumsum(lengths + pauses)[:-1]))
+    n_beats = int(starts[-1] + lengths[-1]) if n_notes else 0
+    n_samples = int((gap_ms + (n_beats + 20) * beat_ms) * sample_rate / 1000)
+    audio = rng.normal(0, noise, n_samples)
+    audio_name = "song." + audio_format
+    # separate generator, so songs without gaps stay the same
+    gap_rng = np.random.default_rng([seed, 1])
+    gap_notes = gap_rng.random(n_notes) < gaps
+    # sung share of the gap notes and whether the gap is at the start or the end
+    sung = gap_rng.uniform(0.3, 0.7, n_notes)
+    late = gap_rng.random(n_notes) < 0.5
+    lines = [
+        "#TITLE:synthetic {0}\n".format(seed),
+        "#ARTIST:ultrastar_pitch\n",
+        "#MP3:{0}\n".format(audio_name),
+        "#BPM:{0}\n".format(bpm),
+        "#GAP:{0}\n".format(gap_ms),
+    ]
+    for idx in range(n_notes):
+        s_start = int((gap_ms + starts[idx] * beat_ms) * sample_rate / 1000)
+        s_end = int((gap_ms + (starts[idx] + lengths[idx]) * beat_ms) * sample_rate / 1000)
+        tone = 0.3 * render_note(int(midis[idx]), s_end - s_start, sample_rate, harmonics, rng)
+        if gap_notes[idx]:
+            n_sung = int(len(tone) * sung[idx])
+            s_start = s_end - n_sung if late[idx] else s_start
+            tone = tone[-n_sung:] if late[idx] else tone[:n_sung]
+        audio[s_start : s_start + len(tone)] += tone
+        note_type = "*" if idx % 10 == 9 else ":"
+        lines.append(
+            "{0} {1} {2} {3} la\n".format(
+                note_type, starts[idx], lengths[idx], midis[idx] - USDX_OFFSET
+            )
+        )
+        if idx % 8 == 7 and idx + 1 < n_notes:
+            lines.append("- {0}\n".format(starts[idx] + lengths[idx]))
+    lines.append("E\n")
+    with open(os.path.join(project_dir, "notes.txt"), "w", encoding="utf-8") as note_file:
+        note_file.writelines(lines)
+    pcm = (np.clip(audio, -1, 1) * 32767).astype("<i2")
+    wav_path = os.path.join(project_dir, "song.wav")
+    with wave.open(wav_path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm.tobytes())
+    if audio_format != "wav":
+        subprocess.run(
+            ["ffmpeg", "-y", "-loglevel", "error", "-i", wav_path, os.path.join(project_dir, audio_name)],
+            check=True,
+        )
+        os.remove(wav_path)
+    return midis - USDX_OFFSET
+
+
+def make_library(library_dir: str, n_songs: int, seed: int = 0, **kwargs) -> list:
+    """ generate n_songs projects in library_dir, returns the paths of their note files """
+    projects = []
+    for idx in range(n_songs):
+        project_dir = os.path.join(library_dir, "song{0:03d}".format(idx))
+        make_project(project_dir, seed=seed + idx, **kwargs)
+        projects.append(os.path.join(project_dir, "notes.txt"))
+    return projects
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("library", help="output folder of the generated projects")
+    parser.add_argument("--songs", type=int, default=8, help="number of projects")
+    parser.add_argument("--notes", type=int, default=200, help="notes per project")
+    parser.add_argument("--density", type=float, default=0.7, help="share of the song covered by notes")
+    parser.add_argument("--bpm", type=float, default=300.0, help="tempo of the projects")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first project")
+    parser.add_argument("--format", default="wav", help="audio format, everything but wav needs ffmpeg")
+    parser.add_argument("--gaps", type=float, default=0.0, help="share of notes sung only partly")
+    args = parser.parse_args()
+    make_library(
+        args.library,
+        args.songs,
+        args.seed,
+        n_notes=args.notes,
+        density=args.density,
+        bpm=args.bpm,
+        audio_format=args.format,
+        gaps=args.gaps,
+    )
+
+
+if __name__ == "__main__":
+    main()
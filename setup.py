@@ -52,7 +52,7 @@ setup(
             "ultrastar-pitch = ultrastar_pitch.ultrastar_pitch:main"
         ]
     },
-    install_requires=["onnxruntime", "scipy", "numpy"],
+    install_requires=["onnxruntime", "scipy", "numpy>=1.20"],
     include_package_data=True,
     zip_safe=False,
 )
@@ -7,8 +7,34 @@
 @author        paradigm
 """
 
-from .project_parser import ProjectParser
-from .audio_preprocessor import AudioPreprocessor
-from .pitch_classifier import PitchClassifier
-from .stochastic_postprocessor import StochasticPostprocessor
-from .detection_pipeline import DetectionPipeline
+import importlib
+
+# public classes and their modules, imported on first access to keep the startup fast
+_CLASSES = {
+    "ProjectParser": ".project_parser",
+    "NoteTable": ".note_table",
+    "AudioCache": ".audio_cache",
+    "AudioDecoder": ".audio_decoder",
+    "AudioPreprocessor": ".audio_preprocessor",
+    "PitchClassifier": ".pitch_classifier",
+    "StochasticPostprocessor": ".stochastic_postprocessor",
+    "ViterbiPostprocessor": ".viterbi_postprocessor",
+    "DetectionPipeline": ".detection_pipeline",
+    "PipelineCancelled": ".detection_pipeline",
+    "SegmentCache": ".segment_cache",
+    "BatchingClassifier": ".batching_classifier",
+    "PipelineProfiler": ".pipeline_profiler",
+}
+
+__all__ = list(_CLASSES)
+
+
+def __getattr__(name: str):
+    """ import the public classes lazily """
+    if name in _CLASSES:
+        return getattr(importlib.import_module(_CLASSES[name], __name__), name)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
+def __dir__() -> list:
+    return sorted(list(globals()) + __all__)
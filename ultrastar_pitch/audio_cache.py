@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@file          audio_cache.py
+@brief         persistent cache for decoded and resampled audio
+@author        paradigm
+"""
+
+import os
+import hashlib
+import logging
+import numpy as np
+
+from .pitch_utils import cache_dir
+
+
+# size of the blocks used to hash the audio files
+HASH_BLOCK_SIZE = 1 << 20
+
+
+class AudioCache:
+    """ least recently used disk cache storing decoded mono pcm as memory mappable npy files """
+
+    def __init__(self, path: str = None, max_size: int = 2 << 30):
+        """ init state variables, max_size is the cache limit in bytes """
+        err_str1 = "{0} has to be an positive integer value"
+        assert isinstance(max_size, int) and max_size > 0, err_str1.format("max_size")
+        self.path = path or os.path.join(cache_dir(), "audio")
+        self.max_size = max_size
+        self.enabled = True
+        try:
+            os.makedirs(self.path, exist_ok=True)
+        except OSError:
+            logging.warning("audio cache %s is not writable, caching disabled", self.path)
+            self.enabled = False
+
+    @staticmethod
+    def key(audio_path: str, sample_rate: int, decoder: str = "ffmpeg") -> str:
+        """ derive the cache key from the audio file content, the sample rate and the decoder kind """
+        audio_hash = hashlib.blake2b(digest_size=16)
+        with open(audio_path, "rb") as audio_file:
+            for block in iter(lambda: audio_file.read(HASH_BLOCK_SIZE), b""):
+                audio_hash.update(block)
+        return "{0}_{1}_{2}".format(audio_hash.hexdigest(), sample_rate, decoder)
+
+    def load(self, key: str) -> np.ndarray:
+        """ returns the memory mapped samples of a cache entry or None on a cache miss """
+        if not self.enabled:
+            return None
+        entry_path = os.path.join(self.path, key + ".npy")
+        try:
+            samples = np.load(entry_path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            # mark entry as recently used
+            os.utime(entry_path)
+        except OSError:
+            pass
+        logging.debug("loaded audio %s from cache", key)
+        return samples
+
+    def store(self, key: str, samples: np.ndarray):
+        """ add samples to the cache and evict old entries if the cache grows too large """
+        if not self.enabled:
+            return
+        entry_path = os.path.join(self.path, key + ".npy")
+        # write to a process specific file first, so concurrent readers never see partial entries
+        tmp_path = "{0}.{1}.tmp".format(entry_path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as entry_file:
+                np.save(entry_file, samples)
+            os.replace(tmp_path, entry_path)
+        except OSError:
+            logging.warning("could not write audio cache entry %s", entry_path)
+            remove_file(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        """ remove the least recently used entries until the cache fits its size limit """
+        if self.enabled:
+            evict_lru(self.path, self.max_size)
+
+    def clear(self):
+        """ remove all entries from the cache """
+        if not self.enabled:
+            return
+        for entry in os.scandir(self.path):
+            if entry.is_file():
+                os.remove(entry.path)
+
+
+def remove_file(path: str):
+    """ remove a file if it exists, failures are ignored """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def evict_lru(path: str, max_size: int):
+    """ remove the least recently modified files of a folder until it fits the size limit
+
+    A cache which can't be listed is left unchanged.
+    """
+    entries = []
+    try:
+        scan = list(os.scandir(path))
+    except OSError:
+        logging.warning("could not list cache %s", path)
+        return
+    for entry in scan:
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if entry.is_file():
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    cache_size = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+        if cache_size <= max_size:
+            break
+        try:
+            os.remove(entry_path)
+            cache_size -= size
+        except OSError:
+            # entry was removed by another process or is still mapped on windows
+            pass
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@file          audio_decoder.py
+@brief         decode audio files into mono 16 bit pcm, in-process for wav/flac/ogg
+               and with ffmpeg for everything else
+@author        paradigm
+"""
+
+import os
+import sys
+import math
+import functools
+import wave
+import asyncio
+import logging
+import threading
+import subprocess
+import numpy as np
+
+
+# number of bytes read from the decoder pipe at once
+PIPE_CHUNK_SIZE = 1 << 16
+# half length of the resampling filter in multiples of the resampling factor, scipy uses 10
+# by default, but 4 is as close to the output of ffmpeg at less than half the cost
+RESAMPLE_HALF_LENGTH = 4
+# file extensions decoded by the wave module
+WAVE_EXTENSIONS = (".wav", ".wave")
+# file extensions decoded by the optional soundfile package
+SOUNDFILE_EXTENSIONS = (".wav", ".wave", ".flac", ".ogg", ".oga")
+
+
+class AudioDecoder:
+    """ decode audio files to mono 16 bit pcm with a given sample rate
+
+    Uncompressed wav files are read with the wave module, flac and ogg files with the
+    soundfile package if it is installed. The samples are resampled in-process with a
+    polyphase filter. Everything else (mp3, containers, in-memory files) is decoded by ffmpeg.
+    """
+
+    def __init__(self, native: bool = True):
+        """ init state variables, native=False always uses ffmpeg """
+        self.native = native
+        # change the ffmpeg path depending on using script or executable
+        if getattr(sys, "frozen", False):
+            self.ffmpeg = os.path.join(sys._MEIPASS, "ffmpeg.exe")
+        else:
+            self.ffmpeg = "ffmpeg"
+
+    def stream(self, source, sample_rate: int = 16000, size_hint: int = 0):
+        """ yield the growing sample buffer of the decoded audio
+
+        source is either the path or the content of the audio file. Every iteration yields the
+        buffer together with the number of valid samples. Natively decoded audio is yielded at once.
+        """
+        samples = self.decode_native(source, sample_rate)
+        if samples is not None:
+            yield samples, len(samples)
+            return
+        yield from self._stream_ffmpeg(source, sample_rate, size_hint)
+
+    def decode(self, source, sample_rate: int = 16000) -> np.ndarray:
+        """ returns the decoded samples of an audio file """
+        samples, n_samples = np.empty(0, dtype="<i2"), 0
+        for samples, n_samples in self.stream(source, sample_rate):
+            pass
+        return samples[:n_samples]
+
+    async def decode_async(self, source, sample_rate: int = 16000) -> np.ndarray:
+        """ returns the decoded samples of an audio file without blocking the event loop
+
+        Native decoding runs in the default executor, ffmpeg as asyncio subprocess.
+        """
+        loop = asyncio.get_running_loop()
+        samples = await loop.run_in_executor(None, self.decode_native, source, sample_rate)
+        if samples is not None:
+            return samples
+        in_memory = isinstance(source, bytes)
+        command = self._ffmpeg_command(None if in_memory else source, sample_rate)
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE if in_memory else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        try:
+            data, _ = await process.communicate(source if in_memory else None)
+        finally:
+            # stop ffmpeg if the caller was cancelled
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        return np.frombuffer(data, dtype="<i2")
+
+    def kind(self, source) -> str:
+        """ returns "native" if the source is decoded in-process, otherwise "ffmpeg"
+
+        Both decoders resample differently, so cached samples have to be kept apart by this kind.
+        """
+        if not self.native or isinstance(source, bytes):
+            return "ffmpeg"
+        extension = os.path.splitext(source)[1].lower()
+        if extension in WAVE_EXTENSIONS or extension in SOUNDFILE_EXTENSIONS:
+            return "native"
+        return "ffmpeg"
+
+    def decode_native(self, source, sample_rate: int = 16000) -> np.ndarray:
+        """ returns the samples of an audio file decoded in-process or None if that isn't possible """
+        if not self.native or isinstance(source, bytes):
+            return None
+        extension = os.path.splitext(source)[1].lower()
+        readers = []
+        if extension in WAVE_EXTENSIONS:
+            readers.append(_read_wave)
+        if extension in SOUNDFILE_EXTENSIONS:
+            readers.append(_read_soundfile)
+        for reader in readers:
+            try:
+                decoded = reader(source)
+            except (EOFError, RuntimeError, ValueError, wave.Error):
+                logging.debug("%s couldn't decode %s", reader.__name__, source, exc_info=True)
+                continue
+            if decoded is not None:
+                samples, source_rate = decoded
+                return self.convert(samples, source_rate, sample_rate)
+        return None
+
+    @staticmethod
+    def convert(samples: np.ndarray, source_rate: int, sample_rate: int = 16000) -> np.ndarray:
+        """ convert pcm samples of shape (samples,) or (samples, channels) to mono 16 bit pcm
+
+        Integer samples are interpreted as 16 bit values, float samples in the range [-1, 1].
+        """
+        err_str1 = "{0} has to be an positive integer value"
+        assert isinstance(source_rate, int) and source_rate > 0, err_str1.format("source_rate")
+        assert isinstance(sample_rate, int) and sample_rate > 0, err_str1.format("sample_rate")
+        is_float = samples.dtype.kind == "f"
+        if samples.ndim > 1 and samples.shape[1] == 1:
+            samples = samples[:, 0]
+        elif samples.ndim > 1:
+            # add up the channels one by one, which is much faster than a mean over the short axis
+            mixed = samples[:, 0].astype(np.float32)
+            for channel in range(1, samples.shape[1]):
+                mixed += samples[:, channel]
+            mixed *= 1 / samples.shape[1]
+            samples = mixed
+        if source_rate != sample_rate:
+            from scipy.signal import resample_poly
+
+            ratio = math.gcd(sample_rate, source_rate)
+            up, down = sample_rate // ratio, source_rate // ratio
+            samples = resample_poly(
+                samples.astype(np.float32, copy=False), up, down, window=_resample_filter(up, down)
+            )
+        if is_float:
+            samples = samples * 32767
+        if samples.dtype == np.int16:
+            return samples.astype("<i2", copy=False)
+        return np.clip(np.round(samples), -32768, 32767).astype("<i2")
+
+    def _ffmpeg_command(self, audio_path: str, sample_rate: int) -> list:
+        """ returns the ffmpeg command decoding an audio file to raw samples on stdout
+
+        audio_path=None reads the encoded audio from stdin.
+        """
+        # decode to mono 16 bit pcm and write the raw samples to stdout
+        return [
+            self.ffmpeg,
+            "-i",
+            "pipe:0" if audio_path is None else audio_path,
+            "-ac",
+            "1",
+            "-ar",
+            str(sample_rate),
+            "-f",
+            "s16le",
+            "-acodec",
+            "pcm_s16le",
+            "pipe:1",
+        ]
+
+    def _stream_ffmpeg(self, source, sample_rate: int, size_hint: int):
+        """ decode an audio file with ffmpeg into a pipe and yield the growing sample buffer """
+        in_memory = isinstance(source, bytes)
+        command = self._ffmpeg_command(None if in_memory else source, sample_rate)
+        subprocess._cleanup()
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE if in_memory else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            shell=False,
+        )
+        writer = None
+        if in_memory:
+            # feed the encoded audio from a thread, so reading stdout can't dead lock
+            writer = threading.Thread(target=_feed_pipe, args=(process.stdin, source), daemon=True)
+            writer.start()
+        # preallocate the buffer, so it usually doesn't need to grow while decoding
+        samples = np.empty(max(size_hint, PIPE_CHUNK_SIZE), dtype="<i2")
+        n_bytes = 0
+        try:
+            while True:
+                if n_bytes + PIPE_CHUNK_SIZE > samples.nbytes:
+                    samples = np.concatenate((samples, np.empty_like(samples)))
+                buffer = samples.view(np.uint8)[n_bytes : n_bytes + PIPE_CHUNK_SIZE]
+                n_read = process.stdout.readinto(buffer)
+                if not n_read:
+                    break
+                n_bytes += n_read
+                yield samples, n_bytes // 2
+        finally:
+            # stop ffmpeg if the consumer doesn't need the remaining audio
+            process.stdout.close()
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            if writer is not None:
+                writer.join()
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+
+@functools.lru_cache(maxsize=8)
+def _resample_filter(up: int, down: int) -> np.ndarray:
+    """ returns the kaiser windowed low pass filter for a polyphase resampler """
+    from scipy.signal import firwin
+
+    max_rate = max(up, down)
+    taps = firwin(2 * RESAMPLE_HALF_LENGTH * max_rate + 1, 1 / max_rate, window=("kaiser", 5.0))
+    return taps.astype(np.float32)
+
+
+def _read_wave(audio_path: str) -> (np.ndarray, int):
+    """ read an integer pcm wav file, returns 16 bit samples of shape (samples, channels) and the rate """
+    with wave.open(audio_path, "rb") as wav_file:
+        n_channels = wav_file.getnchannels()
+        sample_width = wav_file.getsampwidth()
+        frame_rate = wav_file.getframerate()
+        data = wav_file.readframes(wav_file.getnframes())
+    if sample_width == 1:
+        # 8 bit wav files are unsigned
+        samples = (np.frombuffer(data, dtype=np.uint8).astype(np.int16) - 128) << 8
+    elif sample_width == 2:
+        samples = np.frombuffer(data, dtype="<i2")
+    elif sample_width in (3, 4):
+        # keep the 16 most significant bits
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, sample_width)
+        samples = raw[:, -2:].copy().view("<i2").ravel()
+    else:
+        return None
+    return samples.reshape(-1, n_channels), frame_rate
+
+
+def _read_soundfile(audio_path: str) -> (np.ndarray, int):
+    """ read an audio file with the optional soundfile package, returns None if it's missing """
+    try:
+        import soundfile
+    except (ImportError, OSError):
+        return None
+    # libsndfile doesn't scale float files when reading them as integers
+    float_file = soundfile.info(audio_path).subtype in ("FLOAT", "DOUBLE")
+    samples, frame_rate = soundfile.read(
+        audio_path, dtype="float32" if float_file else "int16", always_2d=True
+    )
+    return samples, frame_rate
+
+
+def _feed_pipe(pipe, data: bytes):
+    """ write data into a pipe and close it, the reader may stop early """
+    try:
+        pipe.write(data)
+    except OSError:
+        pass
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
@@ -9,57 +9,236 @@
 """
 
 import logging
+import threading
 import numpy as np
 from scipy.fft import dct
 
 
+# number of frames copied at once, bounds the size of temporary arrays
+GATHER_BLOCK_SIZE = 256
+# preprocessor settings trading accuracy for speed, accurate keeps every frame
+QUALITY_PRESETS = {
+    "fast": {"stride": 256, "max_frames": 4, "sampling": "center"},
+    "balanced": {"stride": 128, "max_frames": 12, "sampling": "even"},
+    "accurate": {"stride": 128, "max_frames": None, "sampling": "even"},
+}
+
+
 class AudioPreprocessor:
     """ calculate the averaged right half of the signals power spectrum and normalizes it """
 
     def __init__(
-        self, sr: int = 16000, win_len: int = 4096, stride: int = 1024
+        self,
+        sr: int = 16000,
+        win_len: int = 4096,
+        stride: int = 1024,
+        dtype: type = np.float64,
+        gate_db: float = None,
+        max_frames: int = None,
+        sampling: str = "even",
     ) -> np.ndarray:
-        """ init state variables """
+        """ init state variables
+
+        With dtype=np.float32 the features are computed in single precision within reusable
+        buffers. The returned features are then only valid until the next transformation of
+        the same thread. gate_db skips frames, whose rms level is below this many dBFS,
+        before the transformation. The loudest frame of a segment is always kept.
+        max_frames limits the frames per segment, which are then either spread evenly over
+        the segment (sampling="even") or taken consecutively from its center (sampling="center").
+        """
         err_str1 = "{0} has to be an positive integer value"
         assert isinstance(sr, int) and sr > 0, err_str1.format("sample_rate")
         assert isinstance(win_len, int) and win_len > 0, err_str1.format(
             "win_len"
         )
         assert isinstance(stride, int) and stride > 0, err_str1.format("stride")
+        assert np.dtype(dtype) in (np.float32, np.float64), "dtype has to be float32 or float64"
+        assert max_frames is None or (
+            isinstance(max_frames, int) and max_frames > 0
+        ), err_str1.format("max_frames")
+        assert sampling in ("even", "center"), "sampling has to be even or center"
+        self.sr = sr
         self.stride = stride
         self.win_len = win_len
+        self.dtype = np.dtype(dtype)
+        self.gate_db = gate_db
+        self.max_frames = max_frames
+        self.sampling = sampling
+        # reusable buffers of the float32 mode, one set per thread
+        self._buffers = threading.local()
+
+    @property
+    def params(self) -> dict:
+        """ getter for the parameters, which influence the generated features """
+        params = {
+            "sr": self.sr,
+            "win_len": self.win_len,
+            "stride": self.stride,
+            "dtype": self.dtype.name,
+        }
+        # only gated features differ, so caches of ungated features stay valid
+        if self.gate_db is not None:
+            params["gate_db"] = self.gate_db
+        if self.max_frames is not None:
+            params["max_frames"] = self.max_frames
+            params["sampling"] = self.sampling
+        return params
+
+    def _buffer(self, name: str, rows: int, cols: int) -> np.ndarray:
+        """ returns a contiguous array with the given shape, reused between calls in float32 mode """
+        if self.dtype != np.float32:
+            return np.empty((rows, cols), dtype=self.dtype)
+        buffer = getattr(self._buffers, name, None)
+        if buffer is None or buffer.shape[0] < rows or buffer.shape[1] != cols:
+            # grow with some headroom to avoid frequent reallocations
+            buffer = np.empty((max(rows, rows * 5 // 4), cols), dtype=self.dtype)
+            setattr(self._buffers, name, buffer)
+        return buffer[:rows]
 
     def transform(self, segment: np.ndarray) -> np.ndarray:
         """ turn an audio segment into mdct spectras """
-        if len(segment) < self.win_len:
-            # zero pad frame to window length before transformation
-            mdct = abs(
-                dct([segment], type=4, n=self.win_len, axis=1)[
-                    :, : self.win_len // 2
-                ]
+        return self.transform_batch(segment, [0], [len(segment)])[0]
+
+    def frame_counts(self, lengths: np.ndarray) -> np.ndarray:
+        """ returns the number of frames of segments with the given lengths """
+        counts = self._stride_counts(np.asarray(lengths))
+        if self.max_frames is not None:
+            counts = np.minimum(counts, self.max_frames)
+        return counts
+
+    def _stride_counts(self, lengths: np.ndarray) -> np.ndarray:
+        """ returns the number of frames fitting into the segments with the dynamic stride """
+        # segments shorter than the window are zero padded to a single frame
+        return np.where(
+            lengths < self.win_len, 1, (lengths - self.win_len) // self._dyn_strides(lengths) + 1
+        )
+
+    def _dyn_strides(self, lengths: np.ndarray) -> np.ndarray:
+        """ use dynamic stride for larger inputs """
+        return self.stride * np.maximum(lengths // self.win_len, 1)
+
+    def frame_layout(self, starts: np.ndarray, ends: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+        """ returns start sample, valid length and segment index of every frame of the segments """
+        lengths = ends - starts
+        dyn_strides = self._dyn_strides(lengths)
+        counts = self.frame_counts(lengths)
+        segment_ids = np.repeat(np.arange(len(starts)), counts)
+        # position of each frame within its segment
+        frame_pos = np.arange(len(segment_ids)) - np.repeat(np.cumsum(counts) - counts, counts)
+        frame_offsets = frame_pos * dyn_strides[segment_ids]
+        if self.max_frames is not None:
+            # segments with more frames than allowed
+            stride_counts = self._stride_counts(lengths)
+            capped = np.flatnonzero(stride_counts[segment_ids] > counts[segment_ids])
+            capped_ids = segment_ids[capped]
+            if self.sampling == "center":
+                # skip the same number of frames at the beginning and the end
+                skipped = (stride_counts[capped_ids] - counts[capped_ids]) // 2
+                frame_offsets[capped] = (frame_pos[capped] + skipped) * dyn_strides[capped_ids]
+            else:
+                # spread the frames from the first to the last possible position
+                span = lengths[capped_ids] - self.win_len
+                frame_offsets[capped] = np.where(
+                    counts[capped_ids] > 1,
+                    frame_pos[capped] * span // np.maximum(counts[capped_ids] - 1, 1),
+                    span // 2,
+                )
+        frame_starts = starts[segment_ids] + frame_offsets
+        frame_lens = np.minimum(lengths[segment_ids], self.win_len)
+        return frame_starts, frame_lens, segment_ids
+
+    def frame_levels(self, samples: np.ndarray, frame_starts: np.ndarray, frame_lens: np.ndarray) -> np.ndarray:
+        """ returns the rms level of every frame in dBFS, short frames are zero padded """
+        if not len(frame_starts):
+            return np.zeros(0)
+        # cumulative energy of the samples covered by the frames
+        first = int(frame_starts.min())
+        last = int((frame_starts + frame_lens).max())
+        energy = np.zeros(last - first + 1)
+        np.cumsum(np.square(samples[first:last], dtype=np.float64), out=energy[1:])
+        frame_energy = energy[frame_starts + frame_lens - first] - energy[frame_starts - first]
+        with np.errstate(divide="ignore"):
+            return 10 * np.log10(frame_energy / (self.win_len * 32768.0 ** 2))
+
+    def _gate(self, levels: np.ndarray, segment_ids: np.ndarray, n_segments: int) -> np.ndarray:
+        """ returns the mask of the frames passing the gate, at least the loudest of every segment """
+        keep = levels >= self.gate_db
+        silent = np.bincount(segment_ids[keep], minlength=n_segments) == 0
+        if silent.any():
+            # every segment has at least one frame, take its first loudest one
+            offsets = np.concatenate(([0], np.cumsum(np.bincount(segment_ids, minlength=n_segments))))
+            loudest = np.maximum.reduceat(levels, offsets[:-1])
+            candidates = np.flatnonzero(silent[segment_ids] & (levels == loudest[segment_ids]))
+            _, first = np.unique(segment_ids[candidates], return_index=True)
+            keep[candidates[first]] = True
+        return keep
+
+    def transform_batch(
+        self, samples: np.ndarray, starts: np.ndarray, ends: np.ndarray
+    ) -> (np.ndarray, np.ndarray):
+        """ turn all segments of a song into mdct spectras at once
+
+        Returns the spectras of all segments and the offsets of each segment within them,
+        the spectras of segment i are features[offsets[i] : offsets[i + 1]].
+        """
+        # segments exceeding the audio are cut off
+        starts = np.clip(np.asarray(starts, dtype=np.int64), 0, len(samples))
+        ends = np.clip(np.asarray(ends, dtype=np.int64), starts, len(samples))
+        frame_starts, frame_lens, segment_ids = self.frame_layout(starts, ends)
+        if self.gate_db is not None:
+            # drop quiet frames before the expensive transformation
+            gate = self._gate(
+                self.frame_levels(samples, frame_starts, frame_lens), segment_ids, len(starts)
             )
-        else:
-            # use dynamic stride for larger inputs
-            dyn_stride = self.stride * (len(segment) // self.win_len)
-            # create stride matrix from segment
-            rows = (len(segment) - self.win_len) // dyn_stride + 1
-            n_stride = segment.strides[0]
-            frames = np.lib.stride_tricks.as_strided(
-                segment,
-                shape=(rows, self.win_len),
-                strides=(dyn_stride * n_stride, n_stride),
+            frame_starts, frame_lens, segment_ids = (
+                frame_starts[gate], frame_lens[gate], segment_ids[gate]
             )
-            mdct = abs(dct(frames, type=4, axis=1)[:, : self.win_len // 2])
+        frames = self._buffer("frames", len(frame_starts), self.win_len)
+        frames[frame_lens == 0] = 0
+        full = np.flatnonzero(frame_lens == self.win_len)
+        if len(full):
+            # gather all complete frames from a strided view of the song
+            windows = np.lib.stride_tricks.sliding_window_view(samples, self.win_len)
+            # copy blockwise to avoid a temporary copy of all frames
+            for idx in range(0, len(full), GATHER_BLOCK_SIZE):
+                rows = full[idx : idx + GATHER_BLOCK_SIZE]
+                frames[rows] = windows[frame_starts[rows]]
+        short = np.flatnonzero((frame_lens < self.win_len) & (frame_lens > 0))
+        if len(short):
+            # zero pad short segments to window length before transformation
+            idx = frame_starts[short, None] + np.arange(self.win_len)
+            valid = np.arange(self.win_len) < frame_lens[short, None]
+            frames[short] = np.where(valid, samples[np.minimum(idx, len(samples) - 1)], 0)
+        # transform in place and keep the right half of the spectrum
+        mdct = dct(frames, type=4, axis=1, overwrite_x=True)[:, : self.win_len // 2]
+        np.abs(mdct, out=mdct)
         # remove spectral offset
         mdct -= mdct.min(keepdims=True, axis=1)
+        peaks = mdct.max(axis=1)
         # strip zero rows from spectrum to avoid division by zero
-        mdct = mdct[~np.all(mdct == 0, axis=1)]
-        # scale spectrum between 0 and 1
-        mdct /= mdct.max(keepdims=True, axis=1)
-        # segment is either silent or corrupt -> return zeros array
-        if np.isnan(mdct).any() or len(mdct) == 0:
+        keep = peaks > 0
+        # segments with invalid values are discarded completely
+        corrupt = np.bincount(segment_ids, weights=np.isnan(peaks), minlength=len(starts)) > 0
+        keep &= ~corrupt[segment_ids]
+        # segment is either silent or corrupt -> keep a single zero row
+        counts = np.bincount(segment_ids, minlength=len(starts))
+        empty = np.bincount(segment_ids[keep], minlength=len(starts)) == 0
+        if empty.any():
             logging.warning(
-                "invalid input introduced nan values. check audio file integrity!"
+                "%d silent or invalid segments. check audio file integrity!", empty.sum()
             )
-            mdct = np.zeros((1, self.win_len // 2))
-        return mdct
+            first_rows = (np.cumsum(counts) - counts)[empty]
+            mdct[first_rows] = 0
+            peaks[first_rows] = 1
+            keep[first_rows] = True
+        # scale spectrum between 0 and 1 and compact the remaining rows blockwise
+        rows = np.flatnonzero(keep)
+        features = self._buffer("features", len(rows), self.win_len // 2)
+        for idx in range(0, len(rows), GATHER_BLOCK_SIZE):
+            block_rows = rows[idx : idx + GATHER_BLOCK_SIZE]
+            block = features[idx : idx + GATHER_BLOCK_SIZE]
+            block[...] = mdct[block_rows]
+            block /= peaks[block_rows, None]
+        offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(segment_ids[keep], minlength=len(starts)), out=offsets[1:])
+        return features, offsets
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@file          batching_classifier.py
+@brief         merge the predictions of concurrent callers into larger batches
+@author        paradigm
+"""
+
+import time
+import queue
+import threading
+import numpy as np
+
+from .pitch_classifier import PitchClassifier
+
+
+# upper bucket edges of the histograms, the last bucket collects everything above
+BATCH_SIZE_BUCKETS = [64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384]
+QUEUE_DELAY_BUCKETS = [0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1]
+
+
+class _Request:
+    """ features of a single caller waiting for their prediction """
+
+    def __init__(self, X: np.ndarray):
+        self.X = X
+        self.submitted = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchingClassifier:
+    """ micro batching wrapper around a pitch classifier
+
+    Concurrent predict calls are collected until max_batch_frames frames are queued or
+    max_delay seconds passed since the first of them. Then the features are predicted with a
+    single session run and the results are split back to the callers. The wrapper can be used
+    everywhere a PitchClassifier is expected.
+    """
+
+    def __init__(
+        self,
+        pitch_classifier: PitchClassifier,
+        max_batch_frames: int = 8192,
+        max_delay: float = 0.002,
+    ):
+        """ init state variables and start the scheduler thread """
+        err_str1 = "{0} has to be an positive integer value"
+        assert (
+            isinstance(max_batch_frames, int) and max_batch_frames > 0
+        ), err_str1.format("max_batch_frames")
+        assert max_delay >= 0, "max_delay has to be a non negative value"
+        self.pitch_classifier = pitch_classifier
+        self.model_id = pitch_classifier.model_id
+        self.max_batch_frames = max_batch_frames
+        self.max_delay = max_delay
+        self._requests = queue.Queue()
+        self._lock = threading.Lock()
+        self._batch_sizes = np.zeros(len(BATCH_SIZE_BUCKETS) + 1, dtype=np.int64)
+        self._queue_delays = np.zeros(len(QUEUE_DELAY_BUCKETS) + 1, dtype=np.int64)
+        self._requests_done = 0
+        self._scheduler = threading.Thread(target=self._schedule, daemon=True)
+        self._scheduler.start()
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        """ predict pitch probabilities, blocks until the batch containing X was processed """
+        request = _Request(X)
+        self._requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def close(self):
+        """ stop the scheduler after the queued requests are processed """
+        self._requests.put(None)
+        self._scheduler.join()
+
+    def stats(self) -> dict:
+        """ returns the histograms of the batch sizes and the queueing delays """
+        with self._lock:
+            batch_sizes = self._batch_sizes.tolist()
+            queue_delays = self._queue_delays.tolist()
+            requests_done = self._requests_done
+        return {
+            "batches": sum(batch_sizes),
+            "requests": requests_done,
+            "batch_size_histogram": dict(
+                zip(["<={0}".format(edge) for edge in BATCH_SIZE_BUCKETS] + ["more"], batch_sizes)
+            ),
+            "queue_delay_histogram": dict(
+                zip(
+                    ["<={0}ms".format(edge * 1e3) for edge in QUEUE_DELAY_BUCKETS] + ["more"],
+                    queue_delays,
+                )
+            ),
+        }
+
+    def _schedule(self):
+        """ collect requests into batches and predict them """
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            batch = [request]
+            n_frames = len(request.X)
+            deadline = request.submitted + self.max_delay
+            stop = False
+            # wait for more requests until the batch is full or the deadline passed
+            while n_frames < self.max_batch_frames:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+                n_frames += len(request.X)
+            self._predict(batch, n_frames)
+            if stop:
+                return
+
+    def _predict(self, batch: list, n_frames: int):
+        """ predict a batch with one session run and hand the results back to the callers """
+        t_start = time.perf_counter()
+        try:
+            if len(batch) == 1:
+                pitches_prob = self.pitch_classifier.predict(batch[0].X)
+            else:
+                pitches_prob = self.pitch_classifier.predict(
+                    np.concatenate([request.X for request in batch]).astype(np.float32, copy=False)
+                )
+            offsets = np.cumsum([len(request.X) for request in batch])[:-1]
+            for request, result in zip(batch, np.split(pitches_prob, offsets)):
+                request.result = result
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        delays = [t_start - request.submitted for request in batch]
+        with self._lock:
+            self._batch_sizes[np.searchsorted(BATCH_SIZE_BUCKETS, n_frames)] += 1
+            np.add.at(self._queue_delays, np.searchsorted(QUEUE_DELAY_BUCKETS, delays), 1)
+            self._requests_done += len(batch)
+        for request in batch:
+            request.done.set()
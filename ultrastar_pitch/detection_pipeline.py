@@ -7,6 +7,9 @@
 @author        paradigm
 """
 
+import copy
+import time
+import asyncio
 import logging
 import numpy as np
 
@@ -14,6 +17,13 @@ from .project_parser import ProjectParser
 from .audio_preprocessor import AudioPreprocessor
 from .pitch_classifier import PitchClassifier
 from .stochastic_postprocessor import StochasticPostprocessor
+from .segment_cache import SegmentCache
+from .pipeline_profiler import stage_event
+from .pitch_utils import peak_rss
+
+
+class PipelineCancelled(Exception):
+    """ raised by a hook to stop the detection of the current song """
 
 
 class DetectionPipeline:
@@ -24,48 +34,304 @@ class DetectionPipeline:
         project_parser: ProjectParser,
         audio_preprocessor: AudioPreprocessor,
         pitch_classifier: PitchClassifier,
-        stochastic_postprocessor: StochasticPostprocessor
+        stochastic_postprocessor: StochasticPostprocessor,
+        segment_cache: SegmentCache = None,
+        max_batch_frames: int = 2048,
     ):
+        err_str1 = "{0} has to be an positive integer value"
+        assert (
+            isinstance(max_batch_frames, int) and max_batch_frames > 0
+        ), err_str1.format("max_batch_frames")
         self.project_parser = project_parser
         self.audio_preprocessor = audio_preprocessor
         self.pitch_classifier = pitch_classifier
+        # any postprocessor with transform(segments_prob), e.g. a ViterbiPostprocessor
         self.stochastic_postprocessor = stochastic_postprocessor
+        # optional cache, which allows to recompute only new or moved segments
+        self.segment_cache = segment_cache
+        # upper limit of frames processed at once, bounds the memory usage
+        self.max_batch_frames = max_batch_frames
+        # callables receiving the stage events, shared with the copies of the pipeline
+        self.hooks = []
+        # note file of the current project, reported with the stage events
+        self._song = None
+
+    def add_hook(self, hook):
+        """ register a callable, which is called with a dict for every finished stage
+
+        The events contain the stage name (parse, decode, preprocess, predict, postprocess,
+        write, song), the song, start and duration in seconds, the number of frames and segments
+        and the peak memory in MB, see PipelineProfiler for a hook collecting them. A hook may
+        raise PipelineCancelled to stop the detection of the current song.
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """ unregister a hook """
+        self.hooks.remove(hook)
+
+    def copy(self) -> "DetectionPipeline":
+        """ returns a pipeline sharing all stages except for the project state
+
+        The preprocessor, classifier and caches are thread safe, only the project parser holds
+        the state of the current song. Copies allow to process songs concurrently with one model.
+        """
+        pipeline = copy.copy(self)
+        pipeline.project_parser = self.project_parser.copy()
+        return pipeline
 
     def transform(
         self, notes_org: str, notes_new: str, postproc: bool = True
     ) -> (np.ndarray, np.ndarray):
         """ load note file, extract audio, detect pitches, and write to new notes.txt """
-        self.project_parser.load_note_file(notes_org)
-        pitches_org = self.project_parser.dump_pitches()
-        pitches_new = []
-        # number of blocks per segment
-        len_arr = []
-        # all singable block features of the song
-        X = []
-        # divide audio into pitch segments
-        for audio_segment in self.project_parser.process_audio():
-            # get block ffts for the segment
-            features = self.audio_preprocessor.transform(audio_segment)
-            # save number of blocks
-            len_arr.append(len(features))
-            # append segment features to song features
-            X.append(features)
-        # predict all block features at once (increases performance a lot!)
-        pitches_prob = self.pitch_classifier.predict(np.vstack(X))
-        # calculate the segment indexes from length array
-        idx_0 = 0
-        for lenght in len_arr:
-            idx_1 = idx_0 + lenght
-            # sum up the pitch probabilities of the segment
-            segment_prob = np.sum(pitches_prob[idx_0:idx_1], axis=0)
-            # determine the pitch with the highest probability of the segment
-            pitches_new.append(segment_prob.argmax())
-            idx_0 = idx_1
+        t_start = time.perf_counter()
+        pitches_org, segments_prob, missing, context = self._load_project(notes_org)
+        if len(missing):
+            segments_prob[missing] = self._predict_segments(missing)
+            self._store_segments(context, missing, segments_prob)
+        pitches_new = self._save_project(notes_new, segments_prob, postproc)
+        self._emit("song", t_start, segments=len(pitches_new))
+        return pitches_org, pitches_new
+
+    def analyse(self, notes_org: str) -> (np.ndarray, np.ndarray):
+        """ detect the pitch probabilities of a project without writing a note file
+
+        returns the original pitches and the summed up pitch probabilities of every segment
+        """
+        t_start = time.perf_counter()
+        pitches_org, segments_prob, missing, context = self._load_project(notes_org)
+        if len(missing):
+            segments_prob[missing] = self._predict_segments(missing)
+            self._store_segments(context, missing, segments_prob)
+        self._emit("song", t_start, segments=len(pitches_org))
+        return pitches_org, segments_prob
+
+    def transform_text(
+        self, note_text, audio, sample_rate: int = None, postproc: bool = True
+    ) -> (str, np.ndarray, np.ndarray):
+        """ detect the pitches of a project held in memory, nothing is read from or written to disk
+
+        note_text is the str or bytes content of a note file. audio is either a numpy pcm array
+        recorded with sample_rate or the bytes of an encoded audio file. Returns the updated note
+        text together with the old and new pitches. The caches are bypassed, since they are
+        stored on disk.
+        """
+        t_start = time.perf_counter()
+        pipeline = copy.copy(self)
+        pipeline.project_parser = self.project_parser.copy()
+        pipeline.project_parser.audio_cache = None
+        pipeline.segment_cache = None
+        pipeline.project_parser.load_note_text(note_text, audio, sample_rate)
+        pitches_org, segments_prob, missing, _ = pipeline._load_project()
+        if len(missing):
+            segments_prob[missing] = pipeline._predict_segments(missing)
+        pitches_new = pipeline._save_project(None, segments_prob, postproc)
+        t_write = time.perf_counter()
+        note_text = pipeline.project_parser.note_text()
+        pipeline._emit("write", t_write, segments=len(pitches_new))
+        pipeline._emit("song", t_start, segments=len(pitches_new))
+        return note_text, pitches_org, pitches_new
+
+    async def transform_async(
+        self, notes_org: str, notes_new: str, postproc: bool = True, executor=None
+    ) -> (np.ndarray, np.ndarray):
+        """ asyncio variant of transform, which doesn't block the event loop
+
+        The audio is decoded by an asyncio subprocess, while file accesses, preprocessing and
+        inference run in the given executor (None uses the default executor of the loop).
+        Every call works on its own copy of the pipeline, so calls may run concurrently.
+        """
+        project = await self._load_project_async(notes_org, executor)
+        return await self._finish_project_async(project, notes_new, postproc, executor)
+
+    async def transform_many_async(
+        self, projects: list, postproc: bool = True, executor=None, return_exceptions: bool = False
+    ):
+        """ transform a list of (notes_org, notes_new) projects and yield the results in order
+
+        The audio of the next project is decoded while the current one is classified. If
+        return_exceptions is set, failures are yielded as exceptions instead of being raised.
+        """
+        loading = None
+        try:
+            for idx, (notes_org, notes_new) in enumerate(projects):
+                if loading is None:
+                    loading = asyncio.ensure_future(self._load_project_async(notes_org, executor))
+                current, loading = loading, None
+                # start decoding the next project before classifying the current one
+                if idx + 1 < len(projects):
+                    loading = asyncio.ensure_future(
+                        self._load_project_async(projects[idx + 1][0], executor)
+                    )
+                try:
+                    project = await current
+                    result = await self._finish_project_async(project, notes_new, postproc, executor)
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    result = e
+                yield result
+        finally:
+            if loading is not None:
+                loading.cancel()
+
+    def _load_project(self, notes_org: str = None) -> tuple:
+        """ parse the note file and look up cached segments, notes_org=None uses the loaded project
+
+        returns the original pitches, the summed up segment probabilities, the indexes of the
+        segments still to be predicted and the segment cache context
+        """
+        t_start = time.perf_counter()
+        self._song = notes_org
+        if notes_org is not None:
+            self.project_parser.load_note_file(notes_org)
+        pitches_org = np.array(self.project_parser.dump_pitches())
+        bounds = self.project_parser.segment_bounds(self.audio_preprocessor.sr)
+        # summed up pitch probabilities of every segment
+        segments_prob = np.zeros((len(bounds), 12))
+        missing = np.arange(len(bounds))
+        context = None
+        if self.segment_cache is not None:
+            context = self.segment_cache.context(
+                self.project_parser.audio_id(self.audio_preprocessor.sr),
+                self.audio_preprocessor.params,
+                self.pitch_classifier.model_id,
+            )
+            segments_prob, missing = self.segment_cache.lookup(context, bounds)
+        self._emit("parse", t_start, segments=len(bounds))
+        return pitches_org, segments_prob, missing, context
+
+    def _store_segments(self, context: str, missing: np.ndarray, segments_prob: np.ndarray):
+        """ add newly predicted segments to the segment cache """
+        if self.segment_cache is not None:
+            bounds = self.project_parser.segment_bounds(self.audio_preprocessor.sr)
+            self.segment_cache.update(context, bounds[missing], segments_prob[missing])
+
+    def _save_project(self, notes_new: str, segments_prob: np.ndarray, postproc: bool) -> np.ndarray:
+        """ derive the pitches from the segment probabilities and write the new note file if given """
+        t_start = time.perf_counter()
         if postproc:
-            # guess song key from pitch distribution
-            key = self.stochastic_postprocessor.detect_key(pitches_new)
-            logging.info("Song was written in key: %d", key)
-            pitches_new[:] = self.stochastic_postprocessor.correct_pitches(key, pitches_new)
+            pitches_new = self.stochastic_postprocessor.transform(segments_prob)
+        else:
+            # determine the pitch with the highest probability of each segment
+            pitches_new = segments_prob.argmax(axis=1)
         self.project_parser.update_pitches(pitches_new)
-        self.project_parser.save_note_file(notes_new)
-        return np.array(pitches_org), np.array(pitches_new)
+        self._emit("postprocess", t_start, segments=len(pitches_new))
+        if notes_new is not None:
+            t_start = time.perf_counter()
+            self.project_parser.save_note_file(notes_new)
+            self._emit("write", t_start, segments=len(pitches_new))
+        return pitches_new
+
+    async def _load_project_async(self, notes_org: str, executor) -> tuple:
+        """ load a project into a new pipeline copy and decode its audio if needed """
+        loop = asyncio.get_running_loop()
+        t_start = time.perf_counter()
+        pipeline = self.copy()
+        pitches_org, segments_prob, missing, context = await loop.run_in_executor(
+            executor, pipeline._load_project, notes_org
+        )
+        samples = None
+        if len(missing):
+            t_decode = time.perf_counter()
+            samples = await pipeline.project_parser.load_audio_async(pipeline.audio_preprocessor.sr)
+            pipeline._emit("decode", t_decode, segments=len(missing))
+        return pipeline, pitches_org, segments_prob, missing, context, samples, t_start
+
+    async def _finish_project_async(
+        self, project: tuple, notes_new: str, postproc: bool, executor
+    ) -> (np.ndarray, np.ndarray):
+        """ predict the decoded segments of a loaded project and write the new note file """
+        loop = asyncio.get_running_loop()
+        pipeline, pitches_org, segments_prob, missing, context, samples, t_start = project
+        if len(missing):
+            segments_prob[missing] = await loop.run_in_executor(
+                executor, pipeline._predict_decoded, samples, missing
+            )
+            await loop.run_in_executor(
+                executor, pipeline._store_segments, context, missing, segments_prob
+            )
+        pitches_new = await loop.run_in_executor(
+            executor, pipeline._save_project, notes_new, segments_prob, postproc
+        )
+        pipeline._emit("song", t_start, segments=len(pitches_new))
+        return pitches_org, pitches_new
+
+    def _predict_decoded(self, samples: np.ndarray, segments: np.ndarray) -> np.ndarray:
+        """ returns the summed up pitch probabilities of segments of completely decoded audio """
+        bounds = self.project_parser.segment_bounds(self.audio_preprocessor.sr)[segments]
+        segments_prob = np.zeros((len(segments), 12))
+        self._predict_chunks(samples, bounds, segments_prob, True)
+        return segments_prob
+
+    def _predict_segments(self, segments: np.ndarray) -> np.ndarray:
+        """ returns the summed up pitch probabilities of the segments with the given indexes """
+        segments_prob = np.zeros((len(segments), 12))
+        # decoded segments, which are not predicted yet
+        pending = np.empty((0, 2), dtype=np.int64)
+        idx_seg = 0
+        samples = np.empty(0, dtype=np.int16)
+        # transform and predict the segments chunkwise as soon as enough of them are decoded
+        t_decode = time.perf_counter()
+        for samples, bounds in self.project_parser.process_audio_batches(
+            self.audio_preprocessor.sr, segments
+        ):
+            # the time waiting for the decoder
+            self._emit("decode", t_decode, segments=len(bounds))
+            pending = np.concatenate((pending, bounds))
+            n_done = self._predict_chunks(samples, pending, segments_prob[idx_seg:], False)
+            pending = pending[n_done:]
+            idx_seg += n_done
+            t_decode = time.perf_counter()
+        self._emit("decode", t_decode)
+        self._predict_chunks(samples, pending, segments_prob[idx_seg:], True)
+        return segments_prob
+
+    def _predict_chunks(
+        self, samples: np.ndarray, bounds: np.ndarray, segments_prob: np.ndarray, flush: bool
+    ) -> int:
+        """ predict chunks of at most max_batch_frames frames, returns the number of predicted segments
+
+        The segments are only predicted if they fill a whole chunk, unless flush is set.
+        """
+        n_frames = np.cumsum(self.audio_preprocessor.frame_counts(bounds[:, 1] - bounds[:, 0]))
+        idx_0 = 0
+        while idx_0 < len(bounds):
+            frames_done = n_frames[idx_0 - 1] if idx_0 else 0
+            if not flush and n_frames[-1] - frames_done < self.max_batch_frames:
+                break
+            # take as many segments as fit into one chunk, but at least one
+            idx_1 = max(
+                idx_0 + 1,
+                int(np.searchsorted(n_frames, frames_done + self.max_batch_frames, side="right")),
+            )
+            t_start = time.perf_counter()
+            features, offsets = self.audio_preprocessor.transform_batch(
+                samples, bounds[idx_0:idx_1, 0], bounds[idx_0:idx_1, 1]
+            )
+            # all frames of the chunk, the prediction only gets the frames passing the gate
+            self._emit("preprocess", t_start, n_frames[idx_1 - 1] - frames_done, idx_1 - idx_0)
+            t_start = time.perf_counter()
+            # predict the features before the preprocessor reuses its buffers
+            pitches_prob = self.pitch_classifier.predict(features)
+            self._emit("predict", t_start, len(features), idx_1 - idx_0)
+            # sum up the pitch probabilities of each segment
+            segments_prob[idx_0:idx_1] = np.add.reduceat(pitches_prob, offsets[:-1], axis=0)
+            idx_0 = idx_1
+        return idx_0
+
+    def _emit(self, stage: str, t_start: float, frames: int = 0, segments: int = 0):
+        """ pass the event of a finished stage to the hooks """
+        if not self.hooks:
+            return
+        event = stage_event(
+            stage, self._song, t_start, time.perf_counter(), frames, segments, peak_rss()
+        )
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except PipelineCancelled:
+                raise
+            except Exception:
+                # a broken metrics exporter must not stop the detection
+                logging.warning("pipeline hook %r failed", hook, exc_info=True)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@file          detection_server.py
+@brief         long running detection service with a warm model and a local job queue
+@author        paradigm
+"""
+
+import json
+import time
+import queue
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .detection_pipeline import DetectionPipeline
+from .pitch_utils import peak_rss, output_path
+
+
+class _Job:
+    """ detection request waiting for a worker """
+
+    def __init__(self, notes_org: str, notes_new: str, postproc: bool):
+        self.notes_org = notes_org
+        self.notes_new = notes_new
+        self.postproc = postproc
+        self.submitted = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DetectionServer:
+    """ process detection jobs from a localhost http endpoint with warm pipelines
+
+    endpoints:
+        POST /detect  {"input": "notes.txt", "output": "notes_new.txt", "postproc": true}
+                      returns {"pitches_old": [...], "pitches_new": [...], ...}
+        GET  /health  returns queue depth, job counters, peak memory and per stage latencies
+
+    The output is a file name, which is written to the folder of the input like in library mode.
+    Posts have to be sent as application/json and without an Origin header, so websites opened
+    in a browser can't submit jobs. The server has no authentication, any client reaching the
+    address can read and write note files, so it should only listen on a loopback address.
+    """
+
+    def __init__(
+        self,
+        detection_pipeline: DetectionPipeline,
+        workers: int = 1,
+        host: str = "127.0.0.1",
+        port: int = 8765,
+    ):
+        """ init state variables, every worker gets its own copy of the pipeline """
+        err_str1 = "{0} has to be an positive integer value"
+        assert isinstance(workers, int) and workers > 0, err_str1.format("workers")
+        self.pipelines = [detection_pipeline.copy() for _ in range(workers)]
+        for pipeline in self.pipelines:
+            # report the stage latencies without registering the hook at the original pipeline
+            pipeline.hooks = pipeline.hooks + [self._record_stage]
+        self.jobs = queue.Queue()
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._active = 0
+        self._counters = {"done": 0, "failed": 0}
+        # stage -> [count, total seconds, max seconds, last seconds]
+        self._latency = {}
+        self.httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+        self.httpd.detection_server = self
+        self._workers = [
+            threading.Thread(target=self._work, args=(pipeline,), daemon=True)
+            for pipeline in self.pipelines
+        ]
+
+    @property
+    def address(self) -> tuple:
+        """ getter for host and port of the endpoint """
+        return self.httpd.server_address[:2]
+
+    def serve_forever(self):
+        """ start the workers and handle requests until shutdown is called """
+        for worker in self._workers:
+            worker.start()
+        logging.info("serving on http://%s:%d", *self.address)
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
+            # stop the workers after they finished their current job
+            for _ in self._workers:
+                self.jobs.put(None)
+
+    def shutdown(self):
+        """ stop serving requests, has to be called from another thread """
+        self.httpd.shutdown()
+
+    def submit(self, notes_org: str, output: str = None, postproc: bool = True) -> dict:
+        """ queue a detection job and wait for its result
+
+        output is the name of the new note file within the folder of notes_org (default=notes_new.txt)
+        """
+        job = _Job(notes_org, output_path(notes_org, output), postproc)
+        self.jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def record(self, stage: str, seconds: float):
+        """ add a latency measurement of a stage to the statistics """
+        with self._lock:
+            stats = self._latency.setdefault(stage, [0, 0.0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] = seconds
+
+    def _record_stage(self, event: dict):
+        """ pipeline hook adding the stage durations to the statistics """
+        self.record(event["stage"], event["duration"])
+
+    def health(self) -> dict:
+        """ returns the state of the server and its latency statistics """
+        # statistics of a batching classifier
+        classifier = self.pipelines[0].pitch_classifier
+        batching = classifier.stats() if hasattr(classifier, "stats") else None
+        with self._lock:
+            return {
+                "status": "ok",
+                "uptime": time.time() - self.started,
+                "workers": len(self.pipelines),
+                "active": self._active,
+                "queue_depth": self.jobs.qsize(),
+                "jobs_done": self._counters["done"],
+                "jobs_failed": self._counters["failed"],
+                "peak_rss": peak_rss(),
+                "latency": {
+                    stage: {"count": count, "mean": total / count, "max": peak, "last": last}
+                    for stage, (count, total, peak, last) in self._latency.items()
+                },
+                "batching": batching,
+            }
+
+    def _work(self, pipeline: DetectionPipeline):
+        """ worker loop processing queued jobs with its own pipeline """
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            t_start = time.perf_counter()
+            self.record("queue", t_start - job.submitted)
+            with self._lock:
+                self._active += 1
+            try:
+                pitches_old, pitches_new = pipeline.transform(
+                    job.notes_org, job.notes_new, job.postproc
+                )
+                job.result = {
+                    "input": job.notes_org,
+                    "output": job.notes_new,
+                    "pitches_old": [int(pitch) for pitch in pitches_old],
+                    "pitches_new": [int(pitch) for pitch in pitches_new],
+                }
+            except Exception as e:
+                logging.debug("job %s failed", job.notes_org, exc_info=True)
+                job.error = e
+            t_end = time.perf_counter()
+            self.record("detect", t_end - t_start)
+            with self._lock:
+                self._active -= 1
+                self._counters["failed" if job.error else "done"] += 1
+            if job.result is not None:
+                job.result["seconds"] = t_end - job.submitted
+            job.done.set()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """ translate http requests into detection jobs """
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, self.server.detection_server.health())
+        else:
+            self._send(404, {"error": "unknown endpoint"})
+
+    def do_POST(self):
+        if self.path != "/detect":
+            self._send(404, {"error": "unknown endpoint"})
+            return
+        # browsers send an origin with cross site requests, which are refused
+        if self.headers.get("Origin") is not None:
+            self._send(403, {"error": "cross origin requests are not allowed"})
+            return
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type != "application/json":
+            self._send(415, {"error": "expected content type application/json"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            notes_org = request["input"]
+        except (ValueError, KeyError, TypeError):
+            self._send(400, {"error": "expected a json object with an input note file"})
+            return
+        try:
+            output_path(notes_org, request.get("output"))
+        except (ValueError, TypeError) as e:
+            self._send(400, {"error": str(e)})
+            return
+        try:
+            result = self.server.detection_server.submit(
+                notes_org, request.get("output"), bool(request.get("postproc", True))
+            )
+        except Exception as e:
+            self._send(500, {"error": "{0}: {1}".format(type(e).__name__, e)})
+            return
+        self._send(200, result)
+
+    def _send(self, status: int, body: dict):
+        """ send a json response """
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        """ route the access log through logging instead of stderr """
+        logging.debug("%s - %s", self.address_string(), format % args)
@@ -9,22 +9,60 @@
 
 import os
 import sys
+import queue
+import threading
 import tkinter as tk
+from tkinter import ttk
 from tkinter import filedialog
 from tkinter import messagebox
 from subprocess import CalledProcessError
 import logging
 
-from .detection_pipeline import DetectionPipeline
+from .detection_pipeline import DetectionPipeline, PipelineCancelled
+from .library_processor import find_projects
+
+# interval of polling the worker events in ms
+POLL_INTERVAL = 50
+# maximum number of failed songs listed after a folder run
+MAX_LISTED_ERRORS = 10
 
 
 class Gui(tk.Frame):
-    """ basic graphical interface for user interaction """
+    """ basic graphical interface for user interaction
+
+    The detection runs on background threads, which report their progress through a queue.
+    The main loop polls the queue, so the window stays responsive.
+    """
 
-    def __init__(self, detection_pipeline: DetectionPipeline, root: tk.Tk = tk.Tk()):
-        """ configure gui widgets for the main application window """
+    def __init__(
+        self,
+        detection_pipeline: DetectionPipeline,
+        root: tk.Tk = None,
+        workers: int = None,
+        threads: int = None,
+    ):
+        """ configure gui widgets for the main application window
+
+        workers is the number of songs processed concurrently in a folder run, threads the number
+        of inference threads of the pipeline (None = all cores). The workers share the model, so
+        by default there are only as many workers as the cores allow (workers x threads <= cores).
+        """
+        # create the root window only when the gui is started, it requires a display
+        root = root or tk.Tk()
         tk.Frame.__init__(self, root)
         self.detection_pipeline = detection_pipeline
+        cores = os.cpu_count() or 1
+        self.workers = workers or max(1, cores // (threads or cores))
+        # events of the worker threads, only the main loop touches the widgets
+        self.events = queue.Queue()
+        self.cancelled = threading.Event()
+        self.running = False
+        # progress of the current run
+        self.n_projects = 0
+        self.finished = {}
+        self.segments = {}
+        # stop running songs as soon as they finish their current stage
+        self.detection_pipeline.add_hook(self._on_stage)
         # build window
         root.title("ultrastar_pitch")
         root.geometry("600x300")
@@ -38,21 +76,30 @@ class Gui(tk.Frame):
         else:
             root.iconphoto(True, tk.PhotoImage(file=os.path.join(icon_path, "icon.png")))
         # text labels
-        path_lbl = tk.Label(root, text="notes.txt:")
+        path_lbl = tk.Label(root, text="notes.txt or song folder:")
         path_lbl.place(x=160, y=80)
         self.done_lbl = tk.Label(root, text="")
         self.done_lbl.place(x=440, y=100)
+        self.progress_lbl = tk.Label(root, text="")
+        self.progress_lbl.place(x=160, y=195)
         # text field
         self.path_txt = tk.Entry(root)
         self.path_txt.insert(0, "notes.txt")
         self.path_txt.bind("<Return>", (lambda event: self.predict_pitches()))
         self.path_txt.place(width=275, x=160, y=100)
         self.path_txt.focus()
-        # load and run buttons
+        # load, folder and run buttons
         load_btn = tk.Button(root, text="Load", command=self.load_notes)
-        load_btn.place(width=100, x=185, y=130)
-        convert_btn = tk.Button(root, text="Run", command=self.predict_pitches)
-        convert_btn.place(width=100, x=310, y=130)
+        load_btn.place(width=85, x=160, y=130)
+        folder_btn = tk.Button(root, text="Folder", command=self.load_folder)
+        folder_btn.place(width=85, x=255, y=130)
+        self.convert_btn = tk.Button(root, text="Run", command=self.predict_pitches)
+        self.convert_btn.place(width=85, x=350, y=130)
+        # progress bar and cancel button
+        self.progress_bar = ttk.Progressbar(root, maximum=100, mode="determinate")
+        self.progress_bar.place(width=275, x=160, y=170)
+        self.cancel_btn = tk.Button(root, text="Cancel", command=self.cancel, state=tk.DISABLED)
+        self.cancel_btn.place(width=85, x=440, y=166)
         # postprocessing checkbutton
         self.postproc_chk_state = tk.BooleanVar()
         self.postproc_chk_state.set(True)
@@ -71,25 +118,144 @@ class Gui(tk.Frame):
         self.path_txt.delete(0, tk.END)
         self.path_txt.insert(0, note_file)
 
+    def load_folder(self):
+        """ callback for folder button, choose a song folder with a filedialog """
+        self.done_lbl.configure(text="")
+        folder = filedialog.askdirectory()
+        if folder:
+            self.path_txt.delete(0, tk.END)
+            self.path_txt.insert(0, folder)
+
     def predict_pitches(self):
-        """ callback for run button, predicts new pitches and generate new notes.txt """
-        status = "failed!"
-        try:
-            notes_org = self.path_txt.get()
-            notes_new = os.path.join(os.path.dirname(notes_org), "notes_new.txt")
-            logging.debug("predicting file: %s", notes_org)
-            logging.debug("postprocessing: %s", self.postproc_chk_state.get())
-            self.detection_pipeline.transform(notes_org, notes_new, self.postproc_chk_state.get())
-            self.done_lbl.configure(text="done!")
-            status = "done!"
-            logging.info("predicted pitches successfully!")
-        except KeyError as e:
-            logging.exception("input file error!\n")
-            messagebox.showerror("error", "invalid input file!\n" + str(e))
-        except CalledProcessError as e:
-            logging.exception("audio file error!\n")
-            messagebox.showerror("error", "invalid audio file!\n" + str(e))
-        except Exception as e:
-            logging.exception("undefined error!\n")
-            messagebox.showerror("error", e)
-        self.done_lbl.configure(text=status)
+        """ callback for run button, predicts new pitches and generate new notes.txt files
+
+        A folder runs every project within it, which are found by the name notes.txt.
+        """
+        if self.running:
+            return
+        path = self.path_txt.get()
+        projects = find_projects(path) if os.path.isdir(path) else [path]
+        if not projects:
+            messagebox.showerror("error", "no notes.txt found in " + path)
+            return
+        logging.debug("predicting %d files: %s", len(projects), path)
+        logging.debug("postprocessing: %s", self.postproc_chk_state.get())
+        self.running = True
+        self.cancelled.clear()
+        self.n_projects = len(projects)
+        self.finished = {}
+        self.segments = {}
+        self.convert_btn.configure(state=tk.DISABLED)
+        self.cancel_btn.configure(state=tk.NORMAL)
+        self.done_lbl.configure(text="")
+        self.progress_bar["value"] = 0
+        jobs = queue.Queue()
+        for project in projects:
+            jobs.put(project)
+        for _ in range(min(self.workers, len(projects))):
+            # every worker processes its songs with its own copy of the pipeline
+            threading.Thread(
+                target=self._work,
+                args=(self.detection_pipeline.copy(), jobs, self.postproc_chk_state.get()),
+                daemon=True,
+            ).start()
+        self.after(POLL_INTERVAL, self._poll)
+
+    def cancel(self):
+        """ callback for cancel button, skip the queued songs and stop the running ones """
+        self.cancelled.set()
+        self.cancel_btn.configure(state=tk.DISABLED)
+        self.progress_lbl.configure(text="cancelling...")
+
+    def _work(self, pipeline: DetectionPipeline, jobs: queue.Queue, postproc: bool):
+        """ worker loop, detect the pitches of queued songs until none is left """
+        while True:
+            try:
+                notes_org = jobs.get_nowait()
+            except queue.Empty:
+                return
+            if self.cancelled.is_set():
+                self.events.put(("finished", notes_org, "cancelled"))
+                continue
+            try:
+                notes_new = os.path.join(os.path.dirname(notes_org), "notes_new.txt")
+                pipeline.transform(notes_org, notes_new, postproc)
+                self.events.put(("finished", notes_org, None))
+                logging.info("predicted pitches successfully!")
+            except PipelineCancelled:
+                self.events.put(("finished", notes_org, "cancelled"))
+            except Exception as e:
+                logging.exception("prediction of %s failed!\n", notes_org)
+                self.events.put(("finished", notes_org, e))
+
+    def _on_stage(self, event: dict):
+        """ pipeline hook, forward the stage events to the main loop and stop cancelled songs """
+        if self.cancelled.is_set() and event["stage"] not in ("write", "song"):
+            raise PipelineCancelled(event["song"])
+        self.events.put(("stage", event["song"], event))
+
+    def _poll(self):
+        """ update the progress with the events of the workers """
+        while True:
+            try:
+                kind, notes_org, value = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "finished":
+                self.finished[notes_org] = value
+                self.segments.pop(notes_org, None)
+            elif value["stage"] == "parse":
+                # all segments of the song, a cached segment is never predicted
+                self.segments[notes_org] = [0, max(value["segments"], 1)]
+            elif value["stage"] == "predict" and notes_org in self.segments:
+                self.segments[notes_org][0] += value["segments"]
+        # finished songs and the predicted share of the running ones
+        progress = len(self.finished) + sum(
+            min(done / total, 1.0) for done, total in self.segments.values()
+        )
+        self.progress_bar["value"] = progress / self.n_projects * 100
+        if len(self.finished) < self.n_projects:
+            if not self.cancelled.is_set():
+                self.progress_lbl.configure(
+                    text="{0}/{1} songs".format(len(self.finished), self.n_projects)
+                )
+            self.after(POLL_INTERVAL, self._poll)
+            return
+        self._finish()
+
+    def _finish(self):
+        """ report the outcome of a finished run """
+        self.running = False
+        self.convert_btn.configure(state=tk.NORMAL)
+        self.cancel_btn.configure(state=tk.DISABLED)
+        errors = {
+            notes_org: error
+            for notes_org, error in self.finished.items()
+            if error is not None and error != "cancelled"
+        }
+        n_cancelled = sum(error == "cancelled" for error in self.finished.values())
+        n_done = self.n_projects - len(errors) - n_cancelled
+        self.progress_lbl.configure(
+            text="{0}/{1} songs done".format(n_done, self.n_projects)
+            + (", {0} cancelled".format(n_cancelled) if n_cancelled else "")
+        )
+        if n_cancelled:
+            self.done_lbl.configure(text="cancelled!")
+        else:
+            self.done_lbl.configure(text="failed!" if errors else "done!")
+        if self.n_projects == 1 and errors:
+            error = next(iter(errors.values()))
+            if isinstance(error, KeyError):
+                messagebox.showerror("error", "invalid input file!\n" + str(error))
+            elif isinstance(error, CalledProcessError):
+                messagebox.showerror("error", "invalid audio file!\n" + str(error))
+            else:
+                messagebox.showerror("error", error)
+        elif errors:
+            listed = [
+                "{0}: {1}".format(notes_org, type(error).__name__)
+                for notes_org, error in sorted(errors.items())[:MAX_LISTED_ERRORS]
+            ]
+            if len(errors) > MAX_LISTED_ERRORS:
+                listed.append("...")
+            messagebox.showerror("error", "{0} songs failed!\n".format(len(errors)) + "\n".join(listed))
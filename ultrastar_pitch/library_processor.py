@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@file          library_processor.py
+@brief         run the pitch detection on a whole song library with a pool
+               of worker processes
+@author        paradigm
+"""
+
+import os
+import time
+import logging
+import functools
+import multiprocessing
+import numpy as np
+
+from .pipeline_profiler import PipelineProfiler
+from .pitch_utils import PITCH_MAP, confusion_matrix, output_path
+from .stochastic_postprocessor import StochasticPostprocessor
+
+
+# warm pipeline of the current worker process, created once by the pool initializer
+_PIPELINE = None
+# profiler collecting the stage events of the worker process, if profiling is enabled
+_PROFILER = None
+
+
+def find_projects(library_dir: str, note_file: str = "notes.txt") -> list:
+    """ walk through a library folder and collect the paths of all project files """
+    projects = []
+    for root, dirs, files in os.walk(library_dir):
+        # walk in a reproducible order
+        dirs.sort()
+        if note_file in files:
+            projects.append(os.path.join(root, note_file))
+    return projects
+
+
+def _init_worker(pipeline_factory, profile: bool = False):
+    """ build the pipeline once per worker, so every song reuses the loaded model """
+    global _PIPELINE, _PROFILER
+    _PIPELINE = pipeline_factory()
+    _PROFILER = None
+    if profile:
+        _PROFILER = PipelineProfiler()
+        _PIPELINE.add_hook(_PROFILER)
+
+
+def _evaluation_pipeline(pipeline_factory):
+    """ returns a pipeline without segment cache, so an evaluation always runs the detection """
+    pipeline = pipeline_factory()
+    pipeline.segment_cache = None
+    return pipeline
+
+
+def _process_project(job: tuple) -> dict:
+    """ detect the pitches of a single project and report the outcome """
+    notes_org, output, postproc = job
+    notes_new = output_path(notes_org, output)
+    result = {"project": notes_org, "output": notes_new, "status": "done", "error": None}
+    t_start = time.perf_counter()
+    try:
+        pitches_org, pitches_new = _PIPELINE.transform(notes_org, notes_new, postproc)
+        result["notes"] = len(pitches_new)
+        # share of unchanged pitches, a rough hint for how much the chart was altered
+        result["agreement"] = float(np.mean(pitches_org == pitches_new)) if len(pitches_new) else None
+    except Exception as e:
+        logging.debug("processing %s failed", notes_org, exc_info=True)
+        result["status"] = "failed"
+        result["error"] = "{0}: {1}".format(type(e).__name__, e)
+    result["seconds"] = time.perf_counter() - t_start
+    if _PROFILER is not None:
+        # hand the stage events of the song over to the main process
+        result["events"] = _PROFILER.pop_events()
+    return result
+
+
+def _evaluate_project(notes_org: str) -> dict:
+    """ compare the detected pitches of a single project with the charted ones """
+    result = {"project": notes_org, "status": "done", "error": None}
+    t_start = time.perf_counter()
+    try:
+        pitches_true, segments_prob = _PIPELINE.analyse(notes_org)
+        pitches_raw = segments_prob.argmax(axis=1)
+        pitches_post = _PIPELINE.stochastic_postprocessor.transform(segments_prob)
+        result["notes"] = len(pitches_true)
+        # key of the chart, detected from the charted pitches
+        result["key"] = (
+            StochasticPostprocessor.detect_key(pitches_true) if len(pitches_true) else None
+        )
+        result["confusion"] = {
+            "raw": confusion_matrix(pitches_true, pitches_raw),
+            "postprocessed": confusion_matrix(pitches_true, pitches_post),
+        }
+    except Exception as e:
+        logging.debug("evaluating %s failed", notes_org, exc_info=True)
+        result["status"] = "failed"
+        result["error"] = "{0}: {1}".format(type(e).__name__, e)
+    result["seconds"] = time.perf_counter() - t_start
+    if _PROFILER is not None:
+        result["events"] = _PROFILER.pop_events()
+    return result
+
+
+def _run_tasks(worker, tasks: list, pipeline_factory, jobs: int, profile: bool):
+    """ run a worker function on all tasks with a pool of warm pipelines and yield the results """
+    err_str1 = "{0} has to be an positive integer value"
+    jobs = jobs or os.cpu_count() or 1
+    assert isinstance(jobs, int) and jobs > 0, err_str1.format("jobs")
+    if jobs == 1 or len(tasks) <= 1:
+        # skip the pool overhead for serial runs
+        _init_worker(pipeline_factory, profile)
+        for task in tasks:
+            yield worker(task)
+        return
+    with multiprocessing.Pool(
+        min(jobs, len(tasks)), initializer=_init_worker, initargs=(pipeline_factory, profile)
+    ) as pool:
+        yield from pool.imap_unordered(worker, tasks, chunksize=1)
+
+
+def process_library(
+    projects: list,
+    pipeline_factory,
+    jobs: int = None,
+    output: str = "notes_new.txt",
+    postproc: bool = True,
+    profile: bool = False,
+):
+    """ process all projects with a pool of worker processes and yield the results as they finish
+
+    pipeline_factory has to be a picklable callable without arguments returning a DetectionPipeline.
+    Every worker calls it once and keeps the pipeline warm for all of its songs. If profile is
+    set, the results contain the stage events of their song as "events". output is the file name
+    of the new note files, which are written to the project folders.
+    """
+    # reject paths before any worker starts, every song would write to the same file
+    output_path("", output)
+    tasks = [(project, output, postproc) for project in projects]
+    yield from _run_tasks(_process_project, tasks, pipeline_factory, jobs, profile)
+
+
+def evaluate_library(projects: list, pipeline_factory, jobs: int = None, profile: bool = False):
+    """ detect the pitches of all projects without writing note files and yield the evaluation
+    of every song as it finishes
+
+    Every result contains the confusion matrices of the raw and the postprocessed pitches
+    against the charted ones, see evaluation_report for aggregating them. The segment cache of
+    the pipelines is bypassed, so the timings of repeated evaluations measure the detection
+    instead of cache reads. Decoded audio is still taken from the audio cache.
+    """
+    yield from _run_tasks(
+        _evaluate_project,
+        list(projects),
+        functools.partial(_evaluation_pipeline, pipeline_factory),
+        jobs,
+        profile,
+    )
+
+
+def summarize(results: list, seconds: float) -> dict:
+    """ aggregate the per song results into a library summary """
+    failed = [result for result in results if result["status"] != "done"]
+    return {
+        "projects": len(results),
+        "succeeded": len(results) - len(failed),
+        "failed": len(failed),
+        "seconds": seconds,
+        "songs_per_second": len(results) / seconds if seconds > 0 else None,
+        "errors": {result["project"]: result["error"] for result in failed},
+        "results": sorted(results, key=lambda result: result["project"]),
+    }
+
+
+def evaluation_report(results: list, seconds: float, n_slowest: int = 10) -> dict:
+    """ aggregate the song evaluations into global, per song and per key accuracies """
+    done = sorted(
+        (result for result in results if result["status"] == "done"),
+        key=lambda result: result["project"],
+    )
+    failed = [result for result in results if result["status"] != "done"]
+    variants = ["raw", "postprocessed"]
+    n_pitches = len(PITCH_MAP)
+    confusion = {
+        variant: sum(
+            (result["confusion"][variant] for result in done),
+            np.zeros((n_pitches, n_pitches), dtype=np.int64),
+        )
+        for variant in variants
+    }
+    notes = np.array([result["notes"] for result in done], dtype=np.int64)
+    correct = {
+        variant: np.array([np.trace(result["confusion"][variant]) for result in done], dtype=np.int64)
+        for variant in variants
+    }
+    songs = []
+    for idx, result in enumerate(done):
+        song = {key: value for key, value in result.items() if key not in ("confusion", "events")}
+        for variant in variants:
+            song[variant] = correct[variant][idx] / notes[idx] if notes[idx] else None
+        songs.append(song)
+    # accuracy per chart key, weighted by the number of notes
+    with_notes = notes > 0
+    keys = np.array([result["key"] for result in done if result["notes"]], dtype=np.int64)
+    key_notes = np.bincount(keys, weights=notes[with_notes], minlength=n_pitches)
+    key_songs = np.bincount(keys, minlength=n_pitches)
+    per_key = {}
+    for key, label in PITCH_MAP.items():
+        if not key_songs[key]:
+            continue
+        per_key[label] = {"songs": int(key_songs[key]), "notes": int(key_notes[key])}
+        for variant in variants:
+            key_correct = np.bincount(keys, weights=correct[variant][with_notes], minlength=n_pitches)
+            per_key[label][variant] = key_correct[key] / key_notes[key]
+    n_notes = int(notes.sum())
+    return {
+        "projects": len(results),
+        "evaluated": len(done),
+        "failed": len(failed),
+        "notes": n_notes,
+        "seconds": seconds,
+        "accuracy": {
+            variant: int(correct[variant].sum()) / n_notes if n_notes else None
+            for variant in variants
+        },
+        # mean of the song accuracies, every song has the same weight
+        "song_accuracy": {
+            variant: float(np.mean(correct[variant][with_notes] / notes[with_notes]))
+            if with_notes.any()
+            else None
+            for variant in variants
+        },
+        "per_key": per_key,
+        "pitch_labels": list(PITCH_MAP.values()),
+        "confusion": {variant: confusion[variant].tolist() for variant in variants},
+        "slowest": sorted(songs, key=lambda song: song["seconds"], reverse=True)[:n_slowest],
+        "errors": {result["project"]: result["error"] for result in failed},
+        "songs": songs,
+    }
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@file          note_table.py
+@brief         columnar storage for the notes of an usdx project
+@author        paradigm
+"""
+
+import numpy as np
+
+
+class NoteTable:
+    """ array backed table of usdx notes
+
+    Every note is a row with its start beat, length in beats, pitch, index of its line in the
+    note file, note type and player. The player is 0 for single player songs and the number of
+    the P marker for duets. Only normal and golden notes are singable, freestyle and rap notes
+    don't have a meaningful pitch.
+    """
+
+    # note types in the order of their type codes
+    NORMAL, GOLDEN, FREESTYLE, RAP, GOLDEN_RAP = range(5)
+    # first character of a note line for each type code
+    TYPE_CHARS = ":*FRG"
+
+    def __init__(
+        self,
+        start: np.ndarray = None,
+        length: np.ndarray = None,
+        pitch: np.ndarray = None,
+        line: np.ndarray = None,
+        note_type: np.ndarray = None,
+        player: np.ndarray = None,
+    ):
+        """ init the columns, missing columns are empty """
+        self.start = np.asarray([] if start is None else start, dtype=np.float64)
+        self.length = np.asarray([] if length is None else length, dtype=np.float64)
+        self.pitch = np.asarray([] if pitch is None else pitch, dtype=np.int64)
+        self.line = np.asarray([] if line is None else line, dtype=np.int64)
+        self.note_type = np.asarray([] if note_type is None else note_type, dtype=np.int8)
+        self.player = np.asarray([] if player is None else player, dtype=np.int8)
+        n_rows = {
+            len(column)
+            for column in (
+                self.start,
+                self.length,
+                self.pitch,
+                self.line,
+                self.note_type,
+                self.player,
+            )
+        }
+        assert len(n_rows) == 1, "all columns need the same number of rows"
+
+    @classmethod
+    def from_lines(cls, lines: list, line_idx: list, players: list) -> "NoteTable":
+        """ parse note lines, line_idx and players hold the line index and player of each of them """
+        # every note line has the format "<type> <start> <length> <pitch> <syllable>"
+        fields = np.array(
+            [lines[idx].split(" ", 4)[1:4] for idx in line_idx], dtype=np.float64
+        ).reshape(-1, 3)
+        return cls(
+            fields[:, 0],
+            fields[:, 1],
+            fields[:, 2].astype(np.int64),
+            line_idx,
+            [cls.TYPE_CHARS.index(lines[idx][0]) for idx in line_idx],
+            players,
+        )
+
+    def __len__(self) -> int:
+        return len(self.line)
+
+    def __getitem__(self, rows) -> "NoteTable":
+        """ returns a table with the selected rows, rows can be an index array or a mask """
+        return NoteTable(
+            self.start[rows],
+            self.length[rows],
+            self.pitch[rows],
+            self.line[rows],
+            self.note_type[rows],
+            self.player[rows],
+        )
+
+    @property
+    def singable(self) -> np.ndarray:
+        """ mask of the normal and golden notes """
+        return (self.note_type == self.NORMAL) | (self.note_type == self.GOLDEN)
+
+    def times(self, gap: float, bpm: float) -> (np.ndarray, np.ndarray):
+        """ returns the start and end of every note in milliseconds """
+        # the 15000 indicates an 1/16 note, while a beat is usually a 1/4 note
+        beat_ms = 15000 / bpm
+        t_start = gap + self.start * beat_ms
+        t_end = gap + (self.start + self.length) * beat_ms
+        return t_start, t_end
+
+    def bounds(self, gap: float, bpm: float, sample_rate: int = 16000) -> np.ndarray:
+        """ returns the first and the last sample of every note as (n, 2) array """
+        t_start, t_end = self.times(gap, bpm)
+        bounds = np.empty((len(self), 2), dtype=np.int64)
+        bounds[:, 0] = np.round((t_start * sample_rate) / 1000)
+        bounds[:, 1] = np.round((t_end * sample_rate) / 1000)
+        return bounds
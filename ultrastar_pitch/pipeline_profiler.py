@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@file          pipeline_profiler.py
+@brief         collect the stage events of detection pipelines and summarize them
+@author        paradigm
+"""
+
+import os
+import json
+import threading
+
+
+class PipelineProfiler:
+    """ pipeline hook collecting stage events
+
+    Register it with DetectionPipeline.add_hook. Every event is a dict with the keys
+    stage, song, start, duration (seconds), frames, segments, peak_rss (MB), pid and thread.
+    The frames of the preprocess stage include the frames skipped by the energy gate of the
+    preprocessor, the frames of the predict stage equal the batch size.
+    """
+
+    # stages in pipeline order, unknown stages are appended to the summary
+    STAGES = ["parse", "decode", "preprocess", "predict", "postprocess", "write", "song"]
+
+    def __init__(self):
+        """ init state variables """
+        self.events = []
+        # hooks are called from the worker threads of all pipeline copies
+        self._lock = threading.Lock()
+
+    def __call__(self, event: dict):
+        """ hook interface, store an event """
+        with self._lock:
+            self.events.append(event)
+
+    def extend(self, events: list):
+        """ add events collected elsewhere, e.g. by the profiler of a worker process """
+        with self._lock:
+            self.events.extend(events)
+
+    def pop_events(self) -> list:
+        """ returns the collected events and forgets them """
+        with self._lock:
+            events, self.events = self.events, []
+        return events
+
+    def summary(self) -> dict:
+        """ returns count, total, mean and max time as well as frames and segments per stage """
+        with self._lock:
+            events = list(self.events)
+        stages = {}
+        for event in events:
+            stats = stages.setdefault(
+                event["stage"],
+                {"count": 0, "seconds": 0.0, "max": 0.0, "frames": 0, "segments": 0},
+            )
+            stats["count"] += 1
+            stats["seconds"] += event["duration"]
+            stats["max"] = max(stats["max"], event["duration"])
+            stats["frames"] += event["frames"]
+            stats["segments"] += event["segments"]
+        for stats in stages.values():
+            stats["mean"] = stats["seconds"] / stats["count"]
+            stats["frames_per_second"] = (
+                stats["frames"] / stats["seconds"] if stats["frames"] and stats["seconds"] else None
+            )
+        order = self.STAGES + sorted(set(stages) - set(self.STAGES))
+        peaks = [event["peak_rss"] for event in events if event["peak_rss"] is not None]
+        # share of the frames skipped before the prediction
+        pruned = None
+        if stages.get("preprocess", {}).get("frames") and "predict" in stages:
+            pruned = 1 - stages["predict"]["frames"] / stages["preprocess"]["frames"]
+        return {
+            "stages": {stage: stages[stage] for stage in order if stage in stages},
+            "peak_rss": max(peaks) if peaks else None,
+            "pruned": pruned,
+        }
+
+    def format_summary(self) -> str:
+        """ returns the summary as printable table """
+        summary = self.summary()
+        # the stages of a song are nested in the song event, so it sets the reference
+        song = summary["stages"].get("song")
+        reference = song["seconds"] if song else sum(
+            stats["seconds"] for stats in summary["stages"].values()
+        )
+        lines = [
+            "{0:<12}{1:>8}{2:>12}{3:>8}{4:>12}{5:>12}{6:>12}".format(
+                "stage", "calls", "total [s]", "share", "mean [ms]", "max [ms]", "frames/s"
+            )
+        ]
+        for stage, stats in summary["stages"].items():
+            lines.append(
+                "{0:<12}{1:>8}{2:>12.3f}{3:>7.1f}%{4:>12.2f}{5:>12.2f}{6:>12}".format(
+                    stage,
+                    stats["count"],
+                    stats["seconds"],
+                    stats["seconds"] / reference * 100 if reference else 0,
+                    stats["mean"] * 1e3,
+                    stats["max"] * 1e3,
+                    "-"
+                    if stats["frames_per_second"] is None
+                    else "{0:.0f}".format(stats["frames_per_second"]),
+                )
+            )
+        if summary["pruned"]:
+            lines.append("pruned frames: {0:.1f}%".format(summary["pruned"] * 100))
+        if summary["peak_rss"] is not None:
+            lines.append("peak memory: {0:.0f} MB".format(summary["peak_rss"]))
+        return "\n".join(lines)
+
+    def chrome_trace(self) -> dict:
+        """ returns the events in the chrome trace event format (chrome://tracing, perfetto) """
+        with self._lock:
+            events = list(self.events)
+        t_zero = min((event["start"] for event in events), default=0.0)
+        trace = []
+        for event in events:
+            timestamp = (event["start"] - t_zero) * 1e6
+            trace.append(
+                {
+                    "name": event["stage"],
+                    "cat": "pipeline",
+                    "ph": "X",
+                    "ts": timestamp,
+                    "dur": event["duration"] * 1e6,
+                    "pid": event["pid"],
+                    "tid": event["thread"],
+                    "args": {
+                        "song": event["song"],
+                        "frames": event["frames"],
+                        "segments": event["segments"],
+                    },
+                }
+            )
+            if event["peak_rss"] is not None:
+                trace.append(
+                    {
+                        "name": "peak_rss",
+                        "ph": "C",
+                        "ts": timestamp + event["duration"] * 1e6,
+                        "pid": event["pid"],
+                        "args": {"MB": event["peak_rss"]},
+                    }
+                )
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+    def save_chrome_trace(self, trace_path: str):
+        """ write the chrome trace of the collected events to a json file """
+        with open(trace_path, "w", encoding="utf-8") as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+
+
+def stage_event(
+    stage: str, song: str, start: float, end: float, frames: int = 0, segments: int = 0, peak_rss: float = None
+) -> dict:
+    """ returns an event as passed to the pipeline hooks """
+    return {
+        "stage": stage,
+        "song": song,
+        "start": start,
+        "duration": end - start,
+        "frames": int(frames),
+        "segments": int(segments),
+        "peak_rss": peak_rss,
+        "pid": os.getpid(),
+        "thread": threading.get_ident(),
+    }
@@ -9,40 +9,183 @@
 
 import os
 import sys
+import logging
+import platform
+import hashlib
+import tempfile
 import numpy as np
 import onnxruntime as rt
 
+from .pitch_utils import cache_dir
+from .audio_cache import remove_file
+
 
 MODEL_NAME = "pitchnet_2020_12_14.onnx"
 
 class PitchClassifier:
     """ determines pitch by a trained neuronal network """
 
-    def __init__(self, model: str = None):
-        """ load and init onnx model """
+    def __init__(
+        self,
+        model: str = None,
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0,
+        parallel: bool = True,
+        allow_spinning: bool = True,
+        memory_arena: bool = True,
+        session_config: dict = None,
+        quantized: bool = False,
+        model_cache: bool = False,
+        cache_path: str = None,
+    ):
+        """ load and init onnx model
+
+        intra_op_threads and inter_op_threads limit the threads of the session (0 = onnxruntime
+        default, which uses all cores). Disabling allow_spinning stops idle threads from busy
+        waiting, which helps when several sessions share a machine. memory_arena toggles the
+        cpu memory arena and memory pattern optimization. session_config allows additional
+        onnxruntime session config entries, e.g. "session.intra_op_thread_affinities".
+
+        quantized loads an int8 dynamically quantized variant of the model (requires the onnx
+        package). With model_cache the optimized graph is stored in ort format within cache_path,
+        so later loads skip the graph optimization. The cached graph contains no hardware specific
+        optimizations and is kept per onnxruntime version, architecture and execution providers.
+        """
+        err_str1 = "{0} has to be a non negative integer value"
+        assert isinstance(intra_op_threads, int) and intra_op_threads >= 0, err_str1.format(
+            "intra_op_threads"
+        )
+        assert isinstance(inter_op_threads, int) and inter_op_threads >= 0, err_str1.format(
+            "inter_op_threads"
+        )
         sess_options = rt.SessionOptions()
-        # enable parallel graph execution
-        sess_options.execution_mode = rt.ExecutionMode.ORT_PARALLEL
+        # run independent graph branches in parallel or sequentially
+        sess_options.execution_mode = (
+            rt.ExecutionMode.ORT_PARALLEL if parallel else rt.ExecutionMode.ORT_SEQUENTIAL
+        )
+        sess_options.intra_op_num_threads = intra_op_threads
+        sess_options.inter_op_num_threads = inter_op_threads
+        spinning = "1" if allow_spinning else "0"
+        sess_options.add_session_config_entry("session.intra_op.allow_spinning", spinning)
+        sess_options.add_session_config_entry("session.inter_op.allow_spinning", spinning)
+        sess_options.enable_cpu_mem_arena = memory_arena
+        sess_options.enable_mem_pattern = memory_arena
+        for key, value in (session_config or {}).items():
+            sess_options.add_session_config_entry(key, str(value))
         # optimize graph at runtime
         sess_options.graph_optimization_level = (
             rt.GraphOptimizationLevel.ORT_ENABLE_ALL
         )
-        if model:
-            # load model from external source
-            self.sess = rt.InferenceSession(model, sess_options)
-        elif getattr(sys, "frozen", False):
-            # load tmodel from meipass (pyinstaller)
-            self.sess = rt.InferenceSession(
-                os.path.join(sys._MEIPASS, MODEL_NAME), sess_options
-            )
-        else:
-            # load models from binary folder
-            self.sess = rt.InferenceSession(
-                os.path.join(os.path.dirname(__file__), "binaries", MODEL_NAME),
-                sess_options,
-            )
+        if not model:
+            if getattr(sys, "frozen", False):
+                # load model from meipass (pyinstaller)
+                model = os.path.join(sys._MEIPASS, MODEL_NAME)
+            else:
+                # load model from binary folder
+                model = os.path.join(os.path.dirname(__file__), "binaries", MODEL_NAME)
+        with open(model, "rb") as model_file:
+            model_bytes = model_file.read()
+        # identify the model by its content, e.g. for caching its predictions
+        self.model_id = hashlib.blake2b(model_bytes, digest_size=16).hexdigest()
+        cache_path = cache_path or os.path.join(cache_dir(), "models")
+        if model_cache:
+            try:
+                os.makedirs(cache_path, exist_ok=True)
+            except OSError:
+                logging.warning("model cache %s is not writable, caching disabled", cache_path)
+                model_cache = False
+        if quantized:
+            model_bytes = self._quantize(model_bytes, cache_path if model_cache else None)
+            self.model_id += "-int8"
+        self.sess = None
+        if model_cache:
+            self.sess = self._cached_session(model_bytes, sess_options, cache_path)
+        if self.sess is None:
+            self.sess = rt.InferenceSession(model_bytes, sess_options)
         self.input_name = self.sess.get_inputs()[0].name
+        self.output_name = self.sess.get_outputs()[0].name
+
+    def _cached_session(self, model_bytes: bytes, sess_options, cache_path: str):
+        """ returns a session of the optimized graph within cache_path, which is created on the
+        first load or when the cached graph is invalid, or None if the graph can't be cached
+        """
+        # the optimized graph depends on the onnxruntime version and the execution providers
+        providers = "-".join(
+            provider.replace("ExecutionProvider", "") for provider in rt.get_available_providers()
+        )
+        optimized_path = os.path.join(
+            cache_path,
+            "{0}_{1}_{2}_{3}.ort".format(self.model_id, rt.__version__, platform.machine(), providers),
+        )
+        optimization_level = sess_options.graph_optimization_level
+        if os.path.exists(optimized_path):
+            # graph is already optimized
+            sess_options.graph_optimization_level = rt.GraphOptimizationLevel.ORT_DISABLE_ALL
+            try:
+                return rt.InferenceSession(optimized_path, sess_options)
+            except Exception:
+                # onnxruntime errors don't share a common base class, e.g. of a truncated file
+                logging.warning("cached model %s is invalid, optimizing the model again", optimized_path)
+                remove_file(optimized_path)
+        tmp_path = "{0}.{1}.tmp".format(optimized_path, os.getpid())
+        sess_options.optimized_model_filepath = tmp_path
+        sess_options.add_session_config_entry("session.save_model_format", "ORT")
+        # layout optimizations depend on the instruction set of the cpu, which may
+        # differ on another machine sharing the cache, so they are left out
+        sess_options.graph_optimization_level = rt.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+        try:
+            sess = rt.InferenceSession(model_bytes, sess_options)
+            os.replace(tmp_path, optimized_path)
+            return sess
+        except Exception:
+            logging.warning("could not write cached model %s, loading the model without cache", optimized_path)
+            remove_file(tmp_path)
+            # the session without cache neither saves the graph nor skips the layout optimizations
+            sess_options.optimized_model_filepath = ""
+            sess_options.graph_optimization_level = optimization_level
+            return None
+
+    @staticmethod
+    def _quantize(model_bytes: bytes, cache_path: str = None) -> bytes:
+        """ returns the int8 dynamically quantized model, reused from cache_path if possible """
+        if cache_path:
+            model_hash = hashlib.blake2b(model_bytes, digest_size=16).hexdigest()
+            quantized_path = os.path.join(cache_path, model_hash + "-int8.onnx")
+            if os.path.exists(quantized_path):
+                with open(quantized_path, "rb") as model_file:
+                    return model_file.read()
+        try:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+        except ImportError as e:
+            raise ImportError("model quantization requires the onnx package") from e
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_path = os.path.join(tmp_dir, "model.onnx")
+            with open(model_path, "wb") as model_file:
+                model_file.write(model_bytes)
+            output_path = os.path.join(tmp_dir, "model-int8.onnx")
+            quantize_dynamic(model_path, output_path, weight_type=QuantType.QInt8)
+            with open(output_path, "rb") as model_file:
+                model_bytes = model_file.read()
+        if cache_path:
+            tmp_path = "{0}.{1}.tmp".format(quantized_path, os.getpid())
+            try:
+                with open(tmp_path, "wb") as model_file:
+                    model_file.write(model_bytes)
+                os.replace(tmp_path, quantized_path)
+            except OSError:
+                logging.warning("could not write quantized model %s", quantized_path)
+                remove_file(tmp_path)
+        return model_bytes
 
     def predict(self, X: np.ndarray) -> np.ndarray:
-        """ predict pitch probabilities from a given feature set (batch_size, feature_size) """
-        return self.sess.run(None, {self.input_name: X.astype(np.float32)})[0]
+        """ predict pitch probabilities from a given feature set (batch_size, feature_size)
+
+        Contiguous float32 features are bound to the session directly without being copied.
+        The method is thread safe, so one classifier can be shared by multiple threads.
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        io_binding = self.sess.io_binding()
+        io_binding.bind_cpu_input(self.input_name, X)
+        io_binding.bind_output(self.output_name)
+        self.sess.run_with_iobinding(io_binding)
+        return io_binding.copy_outputs_to_cpu()[0]
@@ -7,18 +7,37 @@
 @author        paradigm
 """
 
+import os
+import sys
 import numpy as np
 
 # convert between numerical and alphabetic pitch notation
 PITCH_MAP = {0 : "C_", 1 : "C#", 2 : "D_", 3 : "D#", 4 : "E_", 5 : "F_",
              6 : "F#", 7 : "G_", 8 : "G#", 9 : "A_", 10 : "A#", 11 : "B_"}
 
-def prediction_score(y_true: np.ndarray, y_pred: np.ndarray):
-    """ evaluate the prediction by showing accuracy and confusion matrix """
+def output_path(notes_org: str, output: str = None) -> str:
+    """ returns the path of the new note file, output is a file name within the project folder """
+    output = output or "notes_new.txt"
+    # a name only, a song can't write outside of the project folder
+    if not isinstance(output, str) or os.path.basename(output) != output or output in (".", ".."):
+        raise ValueError("output has to be a file name without folder: {0}".format(output))
+    return os.path.join(os.path.dirname(notes_org), output)
+
+
+def confusion_matrix(y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+    """ returns the confusion matrix of the pitches, the rows are the true pitches """
+    n_pitches = len(PITCH_MAP)
+    y_true = np.asarray(y_true, dtype=np.int64)
+    y_pred = np.asarray(y_pred, dtype=np.int64)
+    # count every (true, predicted) pair at once
+    counts = np.bincount(y_true * n_pitches + y_pred, minlength=n_pitches * n_pitches)
+    return counts.reshape(n_pitches, n_pitches)
+
+
+def prediction_score(y_true: np.ndarray, y_pred: np.ndarray) -> float:
+    """ evaluate the prediction by showing accuracy and confusion matrix, returns the accuracy """
     # calculate confusion matrix
-    c_mat = np.zeros((len(PITCH_MAP), len(PITCH_MAP)))
-    for y_t, y_p in zip(y_true, y_pred):
-        c_mat[y_t][y_p] += 1
+    c_mat = confusion_matrix(y_true, y_pred)
     # print detailed confusion matrix
     print("pred", end="\t")
     for label in PITCH_MAP.values():
@@ -29,4 +48,27 @@ def prediction_score(y_true: np.ndarray, y_pred: np.ndarray):
         for val in c_mat[key]:
             print(int(val), end="\t")
         print("")   
-    print("\naccuracy: " + str(np.mean(np.array(y_true) == np.array(y_pred)) * 100) + "%")
+    accuracy = np.mean(np.array(y_true) == np.array(y_pred))
+    print("\naccuracy: " + str(accuracy * 100) + "%")
+    return accuracy
+
+
+def cache_dir() -> str:
+    """ returns the platform specific user cache folder of ultrastar-pitch """
+    if sys.platform == "win32":
+        base_dir = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        base_dir = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base_dir, "ultrastar_pitch")
+
+
+def peak_rss() -> float:
+    """ returns the peak resident set size of the process in MB or None if it is unknown """
+    try:
+        import resource
+    except ImportError:
+        # not available on windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macos reports bytes, linux kilobytes
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
@@ -8,29 +8,40 @@
 @author        paradigm
 """
 import os
-import sys
-import wave
-import subprocess
+import asyncio
+import hashlib
+import logging
 import numpy as np
 
+from .audio_cache import AudioCache
+from .audio_decoder import AudioDecoder
+from .note_table import NoteTable
+
 
 class ProjectParser:
     """ parse an usdx note file and the corresponding audio file  """
 
-    def __init__(self):
-        """ init state variables """
+    def __init__(self, audio_cache: AudioCache = None, decoder: AudioDecoder = None):
+        """ init state variables, decoded audio is reused from audio_cache if provided """
         self.meta = {}
-        # list of dictionarys with singable notes
-        self.singable = []
+        # table of all notes and the row indexes of the singable ones
+        self.notes = NoteTable()
+        self.singable = np.empty(0, dtype=np.int64)
         # buffer for note_file content
         self.file_buffer = []
         # derived project path from note file
         self.proj_dir = 0
-        # change the ffmpeg path depending on using script or executable
-        if getattr(sys, "frozen", False):
-            self.ffmpeg = os.path.join(sys._MEIPASS, "ffmpeg.exe")
-        else:
-            self.ffmpeg = "ffmpeg"
+        # in-memory audio, either pcm samples or the content of an encoded audio file
+        self.audio = None
+        self.audio_rate = None
+        # optional persistent cache for decoded audio
+        self.audio_cache = audio_cache
+        # decoder for the audio files, in-process where possible, ffmpeg otherwise
+        self.decoder = decoder or AudioDecoder()
+
+    def copy(self) -> "ProjectParser":
+        """ returns a new parser with the same configuration, but without project state """
+        return ProjectParser(self.audio_cache, self.decoder)
 
     @property
     def meta(self) -> dict:
@@ -44,106 +55,219 @@ class ProjectParser:
 
     def load_note_file(self, note_file: str):
         """ load and parse usdx project file """
-        self.meta.clear()
-        self.singable.clear()
-        self.file_buffer.clear()
         self.proj_dir = os.path.dirname(note_file)
-        notes = open(note_file, "r", encoding="utf-8-sig")
+        self.audio = None
         # buffer file for later reuse
         try:
-            self.file_buffer = notes.read().splitlines(True)
+            with open(note_file, "r", encoding="utf-8-sig") as notes:
+                file_buffer = notes.read().splitlines(True)
         except UnicodeDecodeError:
             # if the file doesn't use utf-8, try ansi
-            notes = open(note_file, "r", encoding="iso-8859-1")
-            self.file_buffer = notes.read().splitlines(True)
-        for line in self.file_buffer:
+            with open(note_file, "r", encoding="iso-8859-1") as notes:
+                file_buffer = notes.read().splitlines(True)
+        self.parse_lines(file_buffer)
+
+    def load_note_text(self, note_text, audio, sample_rate: int = None):
+        """ parse an usdx project from memory, nothing is read from disk
+
+        note_text can be a str or the bytes of a note file. audio can be a numpy array with
+        mono or (samples, channels) pcm data recorded with sample_rate (integer or float in
+        [-1, 1]), or the bytes of an encoded audio file, which are decoded by ffmpeg via stdin.
+        """
+        if isinstance(note_text, (bytes, bytearray)):
+            try:
+                note_text = note_text.decode("utf-8-sig")
+            except UnicodeDecodeError:
+                # if the file doesn't use utf-8, try ansi
+                note_text = note_text.decode("iso-8859-1")
+        self.proj_dir = ""
+        self.parse_lines(note_text.splitlines(True))
+        if isinstance(audio, np.ndarray):
+            err_str1 = "{0} has to be an positive integer value"
+            assert (
+                isinstance(sample_rate, int) and sample_rate > 0
+            ), err_str1.format("sample_rate")
+            self.audio = audio
+        else:
+            self.audio = bytes(audio)
+        self.audio_rate = sample_rate
+
+    def parse_lines(self, file_buffer: list):
+        """ parse the lines of an usdx project file """
+        self.meta.clear()
+        self.file_buffer = file_buffer
+        line_idx = []
+        players = []
+        # 0 for single player songs, otherwise the number of the last P marker
+        player = 0
+        for idx, line in enumerate(self.file_buffer):
+            first = line[:1]
+            # collect note lines, they are parsed at once afterwards
+            if first and first in NoteTable.TYPE_CHARS:
+                line_idx.append(idx)
+                players.append(player)
             # parse header
-            if line.startswith("#") and not self.singable:
+            elif first == "#" and not line_idx:
                 # remove trailing whitespaces
-                line = line.rstrip("\r").rstrip("\n")
+                line = line.rstrip("\r\n")
                 key, value = line.split(":", 1)
                 if key in ("#BPM", "#GAP"):
                     self.meta[key] = float(value.replace(",", "."))
                 else:
                     self.meta[key] = value
-            # parse singable notes
-            elif line.startswith((":", "*")):
-                line = line.split(" ")
-                pitch = int(line[3]) % 12
-                # start = gap + start_beat * (15000 / bpm)
-                # the 15000 indicates an 1/16 note, while a beat is usually a 1/4 note
-                t_start = self.meta["#GAP"] + float(line[1]) * (
-                    15000 / self.meta["#BPM"]
-                )
-                # end = gap + (start_beat + end_beat) * (15000 / bpm)
-                t_end = self.meta["#GAP"] + (
-                    float(line[1]) + float(line[2])
-                ) * (15000 / self.meta["#BPM"])
-                # append line data to singable list
-                self.singable.append(
-                    {"t_start": t_start, "t_end": t_end, "pitch": pitch}
-                )
-
-    def dump_pitches(self) -> list:
+            # duet marker, the following notes belong to this player
+            elif first == "P":
+                marker = line[1:].strip()
+                if marker.isascii() and marker.isdigit():
+                    player = int(marker)
+                else:
+                    # keep the current player, a broken marker shouldn't discard the song
+                    logging.warning("ignoring invalid player marker in line %d: %s", idx + 1, line.rstrip())
+        self.notes = NoteTable.from_lines(self.file_buffer, line_idx, players)
+        self.singable = np.flatnonzero(self.notes.singable)
+
+    def dump_pitches(self) -> np.ndarray:
         """ returns singable pitches """
-        return [singable["pitch"] for singable in self.singable]
+        return self.notes.pitch[self.singable] % 12
 
     def update_pitches(self, new_pitches: list):
         """ replace old singable pitches by newly calculated ones """
         assert len(new_pitches) == len(
             self.singable
         ), "pitches can't be updated, array size doesn't match!"
-        for singable, new_pitch in zip(self.singable, new_pitches):
-            singable["pitch"] = new_pitch
+        self.notes.pitch[self.singable] = new_pitches
+
+    def note_text(self) -> str:
+        """ returns the content of the note file with the updated pitches """
+        file_buffer = list(self.file_buffer)
+        # go through the singable lines and update their pitch
+        for line_idx, pitch in zip(
+            self.notes.line[self.singable].tolist(), self.notes.pitch[self.singable].tolist()
+        ):
+            line = file_buffer[line_idx].split(" ")
+            line[3] = str(pitch)
+            file_buffer[line_idx] = " ".join(line)
+        return "".join(file_buffer)
 
     def save_note_file(self, note_file: str):
         """ save updated note file under a new name """
-        note_file = open(note_file, "w+", encoding="utf-8")
-        singable = iter(self.singable)
-        # go through old file and update it when needed
-        for line in self.file_buffer:
-            if line.startswith((":", "*")):
-                line = line.split(" ")
-                line[3] = str(int(next(singable)["pitch"]))
-                line = " ".join(line)
-            note_file.write(line)
-
-    def process_audio(self, sample_rate: int = 16000) -> np.ndarray:
-        """ convert, resample and divide audio file into audio segments """
+        with open(note_file, "w+", encoding="utf-8") as notes:
+            notes.write(self.note_text())
+
+    def segment_bounds(self, sample_rate: int = 16000) -> np.ndarray:
+        """ returns the first and the last sample of each singable segment as (n, 2) array """
+        return self.notes[self.singable].bounds(self.meta["#GAP"], self.meta["#BPM"], sample_rate)
+
+    def audio_id(self, sample_rate: int = 16000) -> str:
+        """ returns an unique id for the decoded audio of the project """
+        if self.audio is None:
+            audio_path = os.path.join(self.proj_dir, self.meta["#MP3"])
+            return AudioCache.key(audio_path, sample_rate, self.decoder.kind(audio_path))
+        audio_hash = hashlib.blake2b(digest_size=16)
+        if isinstance(self.audio, np.ndarray):
+            audio_hash.update(str(self.audio_rate).encode("utf-8"))
+            audio_hash.update(np.ascontiguousarray(self.audio).view(np.uint8).ravel())
+        else:
+            audio_hash.update(self.audio)
+        return "{0}_{1}".format(audio_hash.hexdigest(), sample_rate)
+
+    def memory_samples(self, sample_rate: int = 16000) -> np.ndarray:
+        """ returns the in-memory pcm data as mono 16 bit samples with the given sample rate """
+        return AudioDecoder.convert(self.audio, self.audio_rate, sample_rate)
+
+    def stream_audio(self, sample_rate: int = 16000, size_hint: int = 0):
+        """ yield the growing sample buffer of the decoded audio file
+
+        Every iteration yields the buffer together with the number of valid samples.
+        The buffer is reallocated when it runs full, so only the last yielded one is up to date.
+        Cached audio is yielded at once, otherwise the decoded audio is added to the cache
+        after the stream was consumed completely.
+        """
+        if isinstance(self.audio, np.ndarray):
+            samples = self.memory_samples(sample_rate)
+            yield samples, len(samples)
+            return
+        if self.audio is not None:
+            yield from self.decoder.stream(self.audio, sample_rate, size_hint)
+            return
+        audio_path = os.path.join(self.proj_dir, self.meta["#MP3"])
+        if self.audio_cache is None:
+            yield from self.decoder.stream(audio_path, sample_rate, size_hint)
+            return
+        key = self.audio_id(sample_rate)
+        samples = self.audio_cache.load(key)
+        if samples is not None:
+            yield samples, len(samples)
+            return
+        samples, n_samples = np.empty(0, dtype="<i2"), 0
+        for samples, n_samples in self.decoder.stream(audio_path, sample_rate, size_hint):
+            yield samples, n_samples
+        self.audio_cache.store(key, samples[:n_samples])
+
+    async def load_audio_async(self, sample_rate: int = 16000) -> np.ndarray:
+        """ decode the whole audio file without blocking the event loop, returns the samples
+
+        Blocking file accesses of the cache are run in the default executor.
+        """
+        loop = asyncio.get_running_loop()
+        if isinstance(self.audio, np.ndarray):
+            return self.memory_samples(sample_rate)
+        if self.audio is not None:
+            return await self.decoder.decode_async(self.audio, sample_rate)
+        audio_path = os.path.join(self.proj_dir, self.meta["#MP3"])
+        if self.audio_cache is None:
+            return await self.decoder.decode_async(audio_path, sample_rate)
+        key = await loop.run_in_executor(None, self.audio_id, sample_rate)
+        samples = await loop.run_in_executor(None, self.audio_cache.load, key)
+        if samples is None:
+            samples = await self.decoder.decode_async(audio_path, sample_rate)
+            await loop.run_in_executor(None, self.audio_cache.store, key, samples)
+        return samples
+
+    def process_audio_batches(self, sample_rate: int = 16000, segments: list = None):
+        """ convert and resample the audio file, yield the decoded samples with the completed segments
+
+        Every iteration yields the samples decoded so far together with the bounds of the
+        segments, which were completed by them. The segments are passed on in note order as soon
+        as their samples are decoded. Optionally only the segments with the given indexes are used.
+        """
         err_str1 = "{0} has to be an positive integer value"
         assert (
             isinstance(sample_rate, int) and sample_rate > 0
         ), err_str1.format("sample_rate")
-        # convert mp3 to temporary mono wav file
-        audio_path = os.path.join(self.proj_dir, self.meta["#MP3"])
-        wav_path = os.path.join(self.proj_dir, "tmp.wav")
-        subprocess._cleanup()
-        subprocess.run(
-            [
-                self.ffmpeg,
-                "-i",
-                audio_path,
-                "-y",
-                "-ac",
-                "1",
-                "-ar",
-                str(sample_rate),
-                wav_path,
-            ],
-            stdin=subprocess.DEVNULL,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            check=True,
-            shell=False,
-        )
-        # load wav into numpy array for processing and discard file
-        wav_file = wave.open(wav_path)
-        samples_mono = np.frombuffer(
-            wav_file.readframes(wav_file.getnframes()), dtype="int16"
-        )
-        wav_file.close()
-        os.remove(wav_path)
-        for segment in self.singable:
-            start_sample = int(round((segment["t_start"] * sample_rate) / 1000))
-            end_sample = int(round((segment["t_end"] * sample_rate) / 1000))
-            yield samples_mono[start_sample:end_sample]
+        bounds = self.segment_bounds(sample_rate)
+        if segments is not None:
+            bounds = bounds[segments]
+        # a segment is complete, if it and all of its predecessors are decoded
+        ends = np.maximum.accumulate(bounds[:, 1]) if len(bounds) else bounds[:, 1]
+        # reserve one additional second for the decoder buffer
+        size_hint = int(ends[-1]) + sample_rate if len(ends) else 0
+        stream = self.stream_audio(sample_rate, size_hint)
+        samples = np.empty(0, dtype="<i2")
+        n_samples = 0
+        idx_0 = 0
+        try:
+            for samples, n_samples in stream:
+                idx_1 = int(np.searchsorted(ends, n_samples, side="right"))
+                if idx_1 > idx_0:
+                    yield samples[:n_samples], bounds[idx_0:idx_1]
+                    idx_0 = idx_1
+                # keep decoding for the cache, otherwise skip the remaining audio
+                if idx_0 == len(bounds) and self.audio_cache is None:
+                    break
+        finally:
+            stream.close()
+        # the audio ended before the last segments
+        if idx_0 < len(bounds):
+            yield samples[:n_samples], bounds[idx_0:]
+
+    def process_audio(self, sample_rate: int = 16000, segments: list = None) -> np.ndarray:
+        """ convert, resample and divide audio file into audio segments
+
+        The segments are yielded in note order as soon as their samples are decoded.
+        Optionally only the segments with the given indexes are yielded.
+        """
+        for samples, bounds in self.process_audio_batches(sample_rate, segments):
+            for start_sample, end_sample in bounds:
+                yield samples[start_sample:end_sample]
+
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@file          segment_cache.py
+@brief         cache the pitch probabilities of audio segments for incremental re-detection
+@author        paradigm
+"""
+
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from .audio_cache import evict_lru, remove_file
+
+
+class SegmentCache:
+    """ least recently used cache for the summed pitch probabilities of single segments
+
+    Entries are grouped by a context, which combines the audio id, the preprocessor
+    parameters and the model id. Within a context a segment is identified by its first
+    and last sample, so only new or moved segments need to be recomputed after an edit.
+    The contexts are kept in memory and optionally persisted as npz files.
+    """
+
+    def __init__(self, path: str = None, max_size: int = 256 << 20, max_songs: int = 32):
+        """ init state variables, path=None keeps the cache in memory only """
+        err_str1 = "{0} has to be an positive integer value"
+        assert isinstance(max_size, int) and max_size > 0, err_str1.format("max_size")
+        assert isinstance(max_songs, int) and max_songs > 0, err_str1.format("max_songs")
+        self.path = path
+        self.max_size = max_size
+        self.max_songs = max_songs
+        # context -> {(start_sample, end_sample): segment probabilities}
+        self._songs = OrderedDict()
+        # the cache may be shared by pipelines of multiple threads
+        self._lock = threading.Lock()
+        if self.path:
+            try:
+                os.makedirs(self.path, exist_ok=True)
+            except OSError:
+                logging.warning("segment cache %s is not writable, keeping it in memory", self.path)
+                self.path = None
+
+    @staticmethod
+    def context(audio_id: str, preprocessor_params: dict, model_id: str) -> str:
+        """ combine everything the segment probabilities depend on into one key """
+        context = repr((audio_id, sorted(preprocessor_params.items()), model_id))
+        return hashlib.blake2b(context.encode("utf-8"), digest_size=16).hexdigest()
+
+    def lookup(self, context: str, bounds: np.ndarray) -> (np.ndarray, np.ndarray):
+        """ returns the cached probabilities of the segments and the indexes of the missing ones """
+        with self._lock:
+            song = dict(self._load(context))
+        probs = np.zeros((len(bounds), 12))
+        missing = []
+        for idx, bound in enumerate(np.asarray(bounds).tolist()):
+            segment_prob = song.get(tuple(bound))
+            if segment_prob is None:
+                missing.append(idx)
+            else:
+                probs[idx] = segment_prob
+        logging.debug("%d of %d segments cached", len(bounds) - len(missing), len(bounds))
+        return probs, np.array(missing, dtype=int)
+
+    def update(self, context: str, bounds: np.ndarray, probs: np.ndarray):
+        """ add the probabilities of new segments to a context """
+        with self._lock:
+            song = self._load(context)
+            for bound, segment_prob in zip(np.asarray(bounds).tolist(), probs):
+                song[tuple(bound)] = segment_prob
+            if self.path:
+                self._save(context, song)
+
+    def _load(self, context: str) -> dict:
+        """ returns the segments of a context from memory or disk """
+        if context in self._songs:
+            self._songs.move_to_end(context)
+            return self._songs[context]
+        song = {}
+        if self.path:
+            entry_path = os.path.join(self.path, context + ".npz")
+            try:
+                with np.load(entry_path) as entry:
+                    song = {
+                        tuple(bound): segment_prob
+                        for bound, segment_prob in zip(entry["bounds"].tolist(), entry["probs"])
+                    }
+                # mark entry as recently used
+                os.utime(entry_path)
+            except (OSError, KeyError, ValueError):
+                pass
+        self._songs[context] = song
+        # forget the least recently used song
+        if len(self._songs) > self.max_songs:
+            self._songs.popitem(last=False)
+        return song
+
+    def _save(self, context: str, song: dict):
+        """ persist the segments of a context and evict old entries """
+        entry_path = os.path.join(self.path, context + ".npz")
+        tmp_path = "{0}.{1}.tmp".format(entry_path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as entry_file:
+                np.savez(
+                    entry_file,
+                    bounds=np.array(list(song.keys()), dtype=np.int64).reshape(-1, 2),
+                    probs=np.array(list(song.values())).reshape(-1, 12),
+                )
+            os.replace(tmp_path, entry_path)
+        except (OSError, ValueError):
+            # the song was detected already, a lost cache entry only costs a recomputation
+            logging.warning("could not write segment cache entry %s", entry_path)
+            remove_file(tmp_path)
+            return
+        evict_lru(self.path, self.max_size)
+
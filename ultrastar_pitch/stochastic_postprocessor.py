@@ -7,6 +7,7 @@
 @author        paradigm
 """
 
+import logging
 import numpy as np
 
 
@@ -16,7 +17,7 @@ class StochasticPostprocessor:
     # circle of five as stochastic matrix
     # the rows represent the pseudo keys, the columns correspond to the pitch probabilities
     # note: the probabilities where experimentally determined and manually cleaned up
-    KEY_TABLE = np.matrix(
+    KEY_TABLE = np.array(
         [
             [0.19, 0.00, 0.21, 0.00, 0.21, 0.08, 0.00, 0.13, 0.00, 0.11, 0.00, 0.07],
             [0.09, 0.21, 0.00, 0.17, 0.00, 0.18, 0.08, 0.00, 0.13, 0.00, 0.14, 0.00],
@@ -34,7 +35,7 @@ class StochasticPostprocessor:
     )
     
     # circle of five as binary matrix
-    KEY_TABLE_BIN = np.matrix(
+    KEY_TABLE_BIN = np.array(
         [
             [1, 0, 1, 0, 1, 1, 0, 1, 0, 1, 0, 1],
             [1, 1, 0, 1, 0, 1, 1, 0, 1, 0, 1, 0],
@@ -51,26 +52,69 @@ class StochasticPostprocessor:
         ]
     )
 
+    # replacement of every pitch (columns) within every pseudo key (rows), pitches that don't
+    # harmonize with the key are moved to the more likely adjacent pitch
+    CORRECTION_TABLE = np.where(
+        KEY_TABLE > 0,
+        np.arange(12),
+        np.where(
+            np.roll(KEY_TABLE, -1, axis=1) >= np.roll(KEY_TABLE, 1, axis=1),
+            (np.arange(12) + 1) % 12,
+            (np.arange(12) - 1) % 12,
+        ),
+    )
+
+    def __init__(self, key_window: int = 0):
+        """ init state variables
+
+        key_window > 0 detects key changes by scoring a window of that many notes around every
+        note, otherwise a single key is detected for the whole song.
+        """
+        err_str1 = "{0} has to be an positive integer value"
+        assert isinstance(key_window, int) and key_window >= 0, err_str1.format("key_window")
+        self.key_window = key_window
+
+    def transform(self, segments_prob: np.ndarray) -> np.ndarray:
+        """ returns the pitch of every segment corrected by the pseudo key of the song """
+        # determine the pitch with the highest probability of each segment
+        pitches = segments_prob.argmax(axis=1)
+        # guess song key from pitch distribution, per section if key changes are detected
+        keys = self.detect_keys(pitches)
+        sections = keys[np.flatnonzero(np.diff(keys, prepend=-1))]
+        logging.info("Song was written in key: %s", ", ".join(str(key) for key in sections))
+        return self.correct_pitches(keys, pitches)
+
     @classmethod
     def detect_key(cls, pitches: list) -> int:
         """ find the pseudo key of a song by analysing the detected pitches """
         # count the occurance of every pitch
-        pitch_distribution = [
-            np.count_nonzero(np.array(pitches) == x) for x in range(12)
-        ]
+        pitch_distribution = np.bincount(np.asarray(pitches, dtype=np.int64), minlength=12)
         # calculate the weight for each key to dertermine the most likely one
-        return (cls.KEY_TABLE @ pitch_distribution).argmax()
+        return int((cls.KEY_TABLE @ pitch_distribution).argmax())
+
+    def detect_keys(self, pitches: list) -> np.ndarray:
+        """ returns the pseudo key of every note, constant unless key_window is set """
+        pitches = np.asarray(pitches, dtype=np.int64)
+        if not self.key_window or self.key_window >= len(pitches):
+            return np.full(len(pitches), self.detect_key(pitches), dtype=np.int64)
+        # cumulative pitch histograms, the difference of two rows is the histogram in between
+        histograms = np.zeros((len(pitches) + 1, 12), dtype=np.int64)
+        histograms[np.arange(1, len(pitches) + 1), pitches] = 1
+        np.cumsum(histograms, axis=0, out=histograms)
+        # windows centered around every note, shifted inwards at the song borders
+        starts = np.clip(
+            np.arange(len(pitches)) - self.key_window // 2, 0, len(pitches) - self.key_window
+        )
+        windows = histograms[starts + self.key_window] - histograms[starts]
+        return (windows @ self.KEY_TABLE.T).argmax(axis=1)
 
     @classmethod
-    def correct_pitches(cls, key: int, pitches: list) -> list:
-        """ correct the pitches by using the pseudo key probabilities """
-        for idx, pitch in enumerate(pitches):
-            # if pitch doesn't harmonize with key, find a better on
-            if not cls.KEY_TABLE[key, pitch]:
-                # compare adjacent pitches
-                prob_1 = cls.KEY_TABLE[key, (pitch + 1) % 12]
-                prob_2 = cls.KEY_TABLE[key, (pitch - 1) % 12]
-                pitches[idx] = (
-                    (pitch + 1) % 12 if prob_1 >= prob_2 else (pitch - 1) % 12
-                )
+    def correct_pitches(cls, key, pitches: list) -> list:
+        """ correct the pitches by using the pseudo key probabilities
+
+        key is either a single key or an array with the key of every note. The pitches are
+        corrected in place and returned.
+        """
+        corrected = cls.CORRECTION_TABLE[key, np.asarray(pitches, dtype=np.int64)]
+        pitches[:] = corrected if isinstance(pitches, np.ndarray) else corrected.tolist()
         return pitches
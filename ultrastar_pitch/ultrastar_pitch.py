@@ -7,23 +7,231 @@
 @author        paradigm
 """
 
+import os
 import sys
+import json
+import time
 import logging
 import argparse
-import numpy as np
+import functools
+import multiprocessing
 
 from .version import __version__
-from .project_parser import ProjectParser
-from .audio_preprocessor import AudioPreprocessor
-from .pitch_classifier import PitchClassifier
-from .stochastic_postprocessor import StochasticPostprocessor
-from .detection_pipeline import DetectionPipeline
-from .pitch_utils import prediction_score
-from .gui import Gui
+
+# note: numpy, scipy, onnxruntime and tkinter are imported on first use,
+# so the command line starts fast and headless runs never touch a display
+
+
+def create_pipeline(args: argparse.Namespace):
+    """ configure and init the detection pipeline from the command line options """
+    import numpy as np
+    from .project_parser import ProjectParser
+    from .audio_cache import AudioCache
+    from .audio_decoder import AudioDecoder
+    from .audio_preprocessor import AudioPreprocessor, QUALITY_PRESETS
+    from .pitch_classifier import PitchClassifier
+    from .stochastic_postprocessor import StochasticPostprocessor
+    from .viterbi_postprocessor import ViterbiPostprocessor
+    from .detection_pipeline import DetectionPipeline
+    from .segment_cache import SegmentCache
+    from .pitch_utils import cache_dir
+
+    audio_cache = None
+    segment_cache = None
+    cache_root = args.cache_dir or cache_dir()
+    if args.cache:
+        audio_cache = AudioCache(os.path.join(cache_root, "audio"), args.cache_size << 20)
+        segment_cache = SegmentCache(os.path.join(cache_root, "segments"))
+    if args.postprocessor == "viterbi":
+        postprocessor = ViterbiPostprocessor()
+    else:
+        postprocessor = StochasticPostprocessor(args.key_window)
+    return DetectionPipeline(
+        ProjectParser(audio_cache, AudioDecoder(args.native_decode)),
+        AudioPreprocessor(
+            dtype=np.float32 if args.float32 else np.float64,
+            gate_db=args.gate_db,
+            **QUALITY_PRESETS[args.quality]
+        ),
+        PitchClassifier(
+            intra_op_threads=args.threads or 0,
+            inter_op_threads=args.inter_threads,
+            parallel=not args.sequential,
+            allow_spinning=args.spinning,
+            memory_arena=args.mem_arena,
+            quantized=args.quantize,
+            model_cache=args.cache,
+            cache_path=os.path.join(cache_root, "models"),
+        ),
+        postprocessor,
+        segment_cache,
+        args.batch_frames,
+    )
+
+
+def split_threads(args: argparse.Namespace):
+    """ share the cores between the concurrent jobs instead of oversubscribing them
+
+    Without --threads every one of the --jobs pipelines gets cores / jobs inference threads.
+    """
+    if args.threads is None:
+        args.threads = max(1, (os.cpu_count() or 1) // (args.jobs or os.cpu_count() or 1))
+
+
+def run_library(args: argparse.Namespace):
+    """ detect the pitches of every project within a library folder """
+    from .library_processor import find_projects, process_library, summarize
+
+    projects = find_projects(args.library, args.input)
+    split_threads(args)
+    print("found {0} projects in {1}".format(len(projects), args.library))
+    results = []
+    profiler = start_profiler(args)
+    t_start = time.perf_counter()
+    for result in process_library(
+        projects,
+        functools.partial(create_pipeline, args),
+        args.jobs,
+        args.output,
+        args.no_postproc,
+        profiler is not None,
+    ):
+        if profiler is not None:
+            profiler.extend(result.pop("events"))
+        results.append(result)
+        print(
+            "[{0}/{1}] {2}: {3}".format(
+                len(results), len(projects), result["status"], result["project"]
+            )
+        )
+        if result["error"]:
+            print("\t" + result["error"])
+    summary = summarize(results, time.perf_counter() - t_start)
+    print(
+        "\nprocessed {0} projects in {1:.1f}s, {2} succeeded, {3} failed".format(
+            summary["projects"], summary["seconds"], summary["succeeded"], summary["failed"]
+        )
+    )
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as summary_file:
+            json.dump(summary, summary_file, indent=2)
+    stop_profiler(args, profiler)
+
+
+def run_evaluation(args: argparse.Namespace):
+    """ compare the detected pitches of every project within a library folder with the charts """
+    from .library_processor import find_projects, evaluate_library, evaluation_report
+
+    projects = find_projects(args.library, args.input)
+    split_threads(args)
+    print("evaluating {0} projects in {1}".format(len(projects), args.library))
+    results = []
+    profiler = start_profiler(args)
+    t_start = time.perf_counter()
+    for result in evaluate_library(
+        projects, functools.partial(create_pipeline, args), args.jobs, profiler is not None
+    ):
+        if profiler is not None:
+            profiler.extend(result.pop("events"))
+        results.append(result)
+        if result["error"]:
+            print(
+                "[{0}/{1}] failed: {2}\n\t{3}".format(
+                    len(results), len(projects), result["project"], result["error"]
+                )
+            )
+            continue
+        confusion = result["confusion"]
+        print(
+            "[{0}/{1}] {2} notes, raw {3:.1f}%, postprocessed {4:.1f}%: {5}".format(
+                len(results),
+                len(projects),
+                result["notes"],
+                confusion["raw"].trace() / max(result["notes"], 1) * 100,
+                confusion["postprocessed"].trace() / max(result["notes"], 1) * 100,
+                result["project"],
+            )
+        )
+    report = evaluation_report(results, time.perf_counter() - t_start)
+    print(
+        "\nevaluated {0} projects with {1} notes in {2:.1f}s, {3} failed".format(
+            report["evaluated"], report["notes"], report["seconds"], report["failed"]
+        )
+    )
+    if report["notes"]:
+        print(
+            "accuracy raw: {0:.2f}%, postprocessed: {1:.2f}% (song mean {2:.2f}%, {3:.2f}%)".format(
+                report["accuracy"]["raw"] * 100,
+                report["accuracy"]["postprocessed"] * 100,
+                report["song_accuracy"]["raw"] * 100,
+                report["song_accuracy"]["postprocessed"] * 100,
+            )
+        )
+        print("\n{0:<6}{1:>8}{2:>10}{3:>10}{4:>16}".format("key", "songs", "notes", "raw", "postprocessed"))
+        for key, stats in report["per_key"].items():
+            print(
+                "{0:<6}{1:>8}{2:>10}{3:>9.1f}%{4:>15.1f}%".format(
+                    key, stats["songs"], stats["notes"], stats["raw"] * 100, stats["postprocessed"] * 100
+                )
+            )
+        print("\nslowest songs:")
+        for song in report["slowest"][:5]:
+            print("{0:>8.2f}s  {1}".format(song["seconds"], song["project"]))
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as summary_file:
+            json.dump(report, summary_file, indent=2)
+    stop_profiler(args, profiler)
+
+
+def run_server(args: argparse.Namespace):
+    """ keep a warm pipeline and serve detection jobs on a local http endpoint """
+    from .detection_server import DetectionServer
+    from .batching_classifier import BatchingClassifier
+
+    detection_pipeline = create_pipeline(args)
+    if args.batch_delay > 0:
+        # merge the predictions of concurrent jobs into larger batches
+        detection_pipeline.pitch_classifier = BatchingClassifier(
+            detection_pipeline.pitch_classifier,
+            args.batch_frames * args.workers,
+            args.batch_delay / 1000,
+        )
+    profiler = start_profiler(args, detection_pipeline)
+    server = DetectionServer(detection_pipeline, args.workers, args.host, args.port)
+    print("serving on http://{0}:{1}".format(*server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    stop_profiler(args, profiler)
+
+
+def start_profiler(args: argparse.Namespace, detection_pipeline=None):
+    """ returns a profiler attached to the pipeline if --profile is set, otherwise None """
+    if args.profile is None:
+        return None
+    from .pipeline_profiler import PipelineProfiler
+
+    profiler = PipelineProfiler()
+    if detection_pipeline is not None:
+        detection_pipeline.add_hook(profiler)
+    return profiler
+
+
+def stop_profiler(args: argparse.Namespace, profiler):
+    """ print the profile and save the chrome trace if requested """
+    if profiler is None:
+        return
+    print("\n" + profiler.format_summary())
+    if args.profile:
+        profiler.save_chrome_trace(args.profile)
+        print("saved chrome trace to " + args.profile)
 
 
 def main():
     """ ultrastar-pitch entry point """
+    # library workers of a frozen executable start the executable again, run them instead of main
+    multiprocessing.freeze_support()
     print("executing ultrastar-pitch " + __version__ + "\n")
 
     # define and parse flags
@@ -54,6 +262,18 @@ def main():
         action="store_false",
         help="disable statistical postprocessing",
     )
+    parser.add_argument(
+        "--postprocessor",
+        default="stochastic",
+        choices=["stochastic", "viterbi"],
+        help="correct the pitches by the song key or decode the most likely melody (default=stochastic)",
+    )
+    parser.add_argument(
+        "--key-window",
+        type=int,
+        default=0,
+        help="detect key changes within windows of this many notes (default=0, one key per song)",
+    )
     parser.add_argument(
         "-g",
         "--gui",
@@ -61,6 +281,156 @@ def main():
         action="store_true",
         help="enable graphical interface",
     )
+    parser.add_argument(
+        "--float32",
+        default=False,
+        action="store_true",
+        help="compute the features in single precision to save memory",
+    )
+    parser.add_argument(
+        "--quality",
+        default="accurate",
+        choices=["fast", "balanced", "accurate"],
+        help="trade accuracy for speed by using less frames of long notes (default=accurate)",
+    )
+    parser.add_argument(
+        "--gate-db",
+        type=float,
+        default=None,
+        help="skip frames quieter than this rms level in dBFS, e.g. -50 (default=off)",
+    )
+    parser.add_argument(
+        "--no-native-decode",
+        dest="native_decode",
+        action="store_false",
+        help="always decode audio with ffmpeg instead of reading wav/flac/ogg in-process",
+    )
+    parser.add_argument(
+        "--batch-frames",
+        type=int,
+        default=2048,
+        help="maximum number of frames processed at once, bounds the memory usage (default=2048)",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        default=None,
+        help="number of inference threads (default=all cores, with library mode or -j cores / jobs)",
+    )
+    parser.add_argument(
+        "--inter-threads",
+        type=int,
+        default=0,
+        help="number of threads for parallel graph execution (default=all cores)",
+    )
+    parser.add_argument(
+        "--sequential",
+        default=False,
+        action="store_true",
+        help="execute the model graph sequentially",
+    )
+    parser.add_argument(
+        "--no-spinning",
+        dest="spinning",
+        default=True,
+        action="store_false",
+        help="don't let idle inference threads busy wait",
+    )
+    parser.add_argument(
+        "--no-mem-arena",
+        dest="mem_arena",
+        default=True,
+        action="store_false",
+        help="disable the memory arena of the inference session",
+    )
+    parser.add_argument(
+        "--quantize",
+        default=False,
+        action="store_true",
+        help="use the int8 quantized model (requires the onnx package)",
+    )
+    parser.add_argument(
+        "--library",
+        default=None,
+        help="process every project within this folder tree, the project files "
+        "are matched by the input name",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of worker processes for library mode (default=cpu count) "
+        "or concurrent songs of a gui folder run (default=cpu count / threads)",
+    )
+    parser.add_argument(
+        "--summary",
+        default=None,
+        help="write a json summary with per song results of a library run or evaluation",
+    )
+    parser.add_argument(
+        "--evaluate",
+        default=False,
+        action="store_true",
+        help="compare the detected pitches of a library with its charts instead of writing note files",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        default=True,
+        action="store_false",
+        help="disable the caches for decoded audio, segment predictions and optimized models",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="root folder of the caches (default=user cache folder)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=2048,
+        help="size limit of the decoded audio cache in MB (default=2048)",
+    )
+    parser.add_argument(
+        "--serve",
+        default=False,
+        action="store_true",
+        help="run as detection server with a warm model, jobs are posted to /detect",
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="address of the detection server (default=127.0.0.1), the server has no authentication, "
+        "so other addresses than loopback expose the note files to the network",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="port of the detection server (default=8765)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of concurrent jobs of the detection server (default=1)",
+    )
+    parser.add_argument(
+        "--batch-delay",
+        type=float,
+        default=0,
+        help="merge predictions of concurrent server jobs, waiting up to this many ms (default=0)",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="TRACE",
+        help="print the time spent in each stage, optionally save a chrome trace json to TRACE",
+    )
     parser.add_argument(
         "-l",
         "--log",
@@ -68,6 +438,15 @@ def main():
         help="set logging level, e.g.  --log debug, --log warning",
     )
     args = parser.parse_args()
+    if args.evaluate and not args.library:
+        parser.error("--evaluate requires --library")
+    if args.library:
+        from .pitch_utils import output_path
+
+        try:
+            output_path(args.library, args.output)
+        except ValueError:
+            parser.error("-o has to be a file name in library mode, it is written to every project folder")
     # define and set logging level
     log_levels = {
         "critical": logging.CRITICAL,
@@ -81,18 +460,37 @@ def main():
         format="%(levelname)-8s [%(filename)s:%(lineno)d] %(message)s",
         level=log_levels.get(args.log.lower()),
     )
+    # run pitch detection for a whole library
+    if args.library and args.evaluate:
+        run_evaluation(args)
+        return
+    if args.library:
+        run_library(args)
+        return
+    # run pitch detection as a service
+    if args.serve:
+        run_server(args)
+        return
+    gui = args.gui or getattr(sys, "frozen", False)
+    if gui and args.jobs:
+        # concurrent songs of a folder run share the cores like in library mode
+        split_threads(args)
     # configure and init pipeline pitch detection
-    detection_pipeline = DetectionPipeline(
-        ProjectParser(), AudioPreprocessor(stride=128), PitchClassifier(), StochasticPostprocessor()
-    )
+    detection_pipeline = create_pipeline(args)
     # run graphical user interface for pitch detection
-    if args.gui or getattr(sys, "frozen", False):
-        Gui(detection_pipeline)
+    if gui:
+        from .gui import Gui
+
+        Gui(detection_pipeline, workers=args.jobs, threads=args.threads)
         return
+    profiler = start_profiler(args, detection_pipeline)
     # run command line interface for pitch detection
     pitches_old, pitches_new = detection_pipeline.transform(
         args.input, args.output, args.no_postproc
     )
+    stop_profiler(args, profiler)
     # output confusion matrix with prediction score
     if args.accuracy:
-        prediction_score(np.array(pitches_old), np.array(pitches_new))
+        from .pitch_utils import prediction_score
+
+        prediction_score(pitches_old, pitches_new)
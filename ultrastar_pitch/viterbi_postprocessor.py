@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@file          viterbi_postprocessor.py
+@brief         decode the most likely pitch sequence from the segment probabilities
+@author        paradigm
+"""
+
+import numpy as np
+
+from .stochastic_postprocessor import StochasticPostprocessor
+
+
+# probability of the intervals between successive notes in semitones modulo 12,
+# unisons and seconds dominate sung melodies, the tritone is rare
+INTERVAL_TABLE = np.array(
+    [0.24, 0.10, 0.14, 0.06, 0.04, 0.05, 0.02, 0.05, 0.04, 0.06, 0.14, 0.10]
+)
+
+
+class ViterbiPostprocessor:
+    """ improve the pitch detection with a hidden markov model over the note sequence
+
+    The hidden states are pairs of pseudo key and pitch. The pitches of a key follow
+    StochasticPostprocessor.KEY_TABLE, successive pitches the interval table and the key
+    changes between two notes with a small probability. The segment probabilities of the
+    classifier are the observations. The postprocessor can be used everywhere a
+    StochasticPostprocessor is expected.
+    """
+
+    def __init__(
+        self,
+        interval_table: np.ndarray = None,
+        key_change: float = 1e-3,
+        out_of_key: float = 0.02,
+        observation_weight: float = 1.0,
+    ):
+        """ init state variables and precompute the log transition tables
+
+        interval_table holds the probability of every interval modulo 12 (default=INTERVAL_TABLE),
+        see fit_intervals for learning it from charted songs. out_of_key is the probability
+        of pitches, which don't belong to the key at all.
+        """
+        interval_table = INTERVAL_TABLE if interval_table is None else np.asarray(interval_table)
+        assert interval_table.shape == (12,), "interval_table has to contain 12 probabilities"
+        assert 0 <= key_change < 1, "key_change has to be in [0, 1)"
+        assert 0 < out_of_key < 1, "out_of_key has to be in (0, 1)"
+        assert observation_weight > 0, "observation_weight has to be a positive value"
+        self.interval_table = interval_table / interval_table.sum()
+        self.key_change = key_change
+        self.out_of_key = out_of_key
+        self.observation_weight = observation_weight
+        # pitch probabilities of every key, pitches outside of the key are unlikely but possible
+        key_table = np.maximum(StochasticPostprocessor.KEY_TABLE, out_of_key)
+        key_table /= key_table.sum(axis=1, keepdims=True)
+        self._log_key = np.log(key_table)
+        # the key stays or changes to any other key with the same probability
+        with np.errstate(divide="ignore"):
+            self._log_key_stay = np.log(1 - key_change)
+            self._log_key_change = np.log(key_change / 11)
+        # pitch transitions within the next key [next key, pitch, next pitch], normalized
+        # over the next pitch, so every state emits a proper distribution
+        intervals = self.interval_table[(np.arange(12)[None, :] - np.arange(12)[:, None]) % 12]
+        pitch_change = intervals[None, :, :] * key_table[:, None, :]
+        pitch_change /= pitch_change.sum(axis=2, keepdims=True)
+        # stored as [next key, next pitch, pitch], so the maximum runs over the contiguous axis
+        self._log_pitch_change = np.ascontiguousarray(np.log(pitch_change).transpose(0, 2, 1))
+
+    @staticmethod
+    def fit_intervals(songs: list, smoothing: float = 1.0) -> np.ndarray:
+        """ returns the interval table estimated from the pitch sequences of charted songs """
+        counts = np.full(12, smoothing, dtype=np.float64)
+        for pitches in songs:
+            counts += np.bincount(np.diff(np.asarray(pitches, dtype=np.int64)) % 12, minlength=12)
+        return counts / counts.sum()
+
+    def transform(self, segments_prob: np.ndarray) -> np.ndarray:
+        """ returns the most likely pitch of every segment """
+        keys, pitches = self.decode(segments_prob)
+        return pitches
+
+    def decode(self, segments_prob: np.ndarray) -> (np.ndarray, np.ndarray):
+        """ returns the most likely sequence of keys and pitches for the segment probabilities
+
+        segments_prob holds the (unnormalized) probabilities of the 12 pitches of every segment.
+        """
+        n_notes = len(segments_prob)
+        if not n_notes:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        # normalized log observation probabilities [note, pitch]
+        observations = np.asarray(segments_prob, dtype=np.float64)
+        observations = observations / np.maximum(observations.sum(axis=1, keepdims=True), 1e-12)
+        log_obs = self.observation_weight * np.log(np.maximum(observations, 1e-12))
+        # log probability of the best path ending in [key, pitch]
+        score = np.log(1 / 12) + self._log_key + log_obs[0]
+        # back pointers: whether the key stays for [next key, pitch], otherwise the best key
+        # of the previous pitch, and the best previous pitch of [next key, next pitch]
+        key_stays = np.zeros((n_notes, 12, 12), dtype=bool)
+        best_keys = np.zeros((n_notes, 12), dtype=np.int64)
+        prev_pitches = np.zeros((n_notes, 12, 12), dtype=np.int64)
+        for idx in range(1, n_notes):
+            # the maxima over the previous key and pitch are separable, first choose the best
+            # previous key for every [next key, previous pitch], which is either the same key
+            # or the best key of the previous pitch, then choose the best previous pitch
+            stay_score = score + self._log_key_stay
+            change_score = score.max(axis=0) + self._log_key_change
+            key_stays[idx] = stay_score >= change_score
+            best_keys[idx] = score.argmax(axis=0)
+            pitch_score = np.maximum(stay_score, change_score)[:, None, :] + self._log_pitch_change
+            prev_pitches[idx] = pitch_score.argmax(axis=2)
+            score = pitch_score.max(axis=2) + log_obs[idx]
+        # follow the back pointers from the best final state
+        keys = np.zeros(n_notes, dtype=np.int64)
+        pitches = np.zeros(n_notes, dtype=np.int64)
+        keys[-1], pitches[-1] = np.unravel_index(score.argmax(), score.shape)
+        for idx in range(n_notes - 1, 0, -1):
+            pitches[idx - 1] = prev_pitches[idx, keys[idx], pitches[idx]]
+            keys[idx - 1] = (
+                keys[idx] if key_stays[idx, keys[idx], pitches[idx - 1]] else best_keys[idx, pitches[idx - 1]]
+            )
+        return keys, pitches